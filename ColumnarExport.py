@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# Export of the forms column by column, with the type of each field, for the analysis tools
+#   - 'parquet' with pyarrow: compressed (EASYNUT_PARQUET_COMPRESSION, snappy by default),
+#     written by row groups so the memory used does not depend on the size of the table
+#   - 'npz' with numpy: one compressed array per column, the whole table is kept in memory while writing
+# Both are optional, the csv export stays the default.
+# Types, from the type of the fields (FieldConfig):
+#   - date: date (parquet date32, numpy datetime64[D]), NaT/null when empty or invalid
+#   - int: float64, as the "int" fields also hold decimals (weights...), NaN/null when empty
+#   - select and radio: categories (parquet dictionary, numpy int32 codes and the categories, -1 when empty)
+#   - text and notes: strings (numpy unicode array and a mask of the empty values)
+# The columns are the ones of the csv export, with the DB ID of the records first.
+# In the npz files, column i is the array "c<i>", its name is in "columns" and its kind in "kinds",
+# with "c<i>_categories" for the categories and "c<i>_null" for the mask of the strings.
+
+from __future__ import unicode_literals
+import datetime
+
+from django.conf import settings
+
+from .EasyDBObjects import FieldConfig
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Formats which can be used, the csv one always
+def available_formats():
+    formats = ['csv']
+    if pyarrow is not None:
+        formats.append('parquet')
+    if numpy is not None:
+        formats.append('npz')
+    return formats
+
+
+# Kind of the column of a field
+def kind(fieldc):
+    if fieldc['type'] == FieldConfig.field_type_date:
+        return 'date'
+    elif fieldc['type'] == FieldConfig.field_type_int:
+        return 'number'
+    elif fieldc['type'] in (FieldConfig.field_type_sel, FieldConfig.field_type_rad):
+        return 'category'
+    return 'text'
+
+
+def to_date(value):
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.datetime.strptime(str(value), '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_text(value):
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return '{}'.format(value)
+
+
+# Value of a cell, None when empty
+# *TBC*#
+# Some empty values were saved as the string 'NULL'
+def convert(kind, value):
+    if value is None or value == '' or value == 'NULL':
+        return None
+    if kind == 'date':
+        return to_date(value)
+    elif kind == 'number':
+        return to_number(value)
+    elif kind in ('id', 'timestamp'):
+        return value
+    return to_text(value)
+
+
+class ColumnarExporter(object):
+
+    extensions = {'parquet': '.parquet', 'npz': '.npz'}
+    rows_per_batch = 10000
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+
+    def filename(self, tablec, fmt):
+        return self.exporter.csvname(tablec)[:-len('.csv')] + self.extensions[fmt]
+
+    # Names, kinds and query of the columns of a form
+    def columns(self, tablec):
+        columns, sqlquery = self.exporter.query(tablec, with_id=True)
+        kinds = ['id'] + [kind(fieldc) for fieldc in tablec['fields'][:-1]] + ['text', 'timestamp']
+        return columns, kinds, sqlquery
+
+    # Yield the rows of a form by batches of converted columns
+    def batches(self, db, tablec, kinds, sqlquery, rows_per_batch, progress):
+        batch = [[] for k in kinds]
+        counter = 0
+        for counter, row in enumerate(self.exporter.rows(db, tablec, sqlquery), 1):
+            for values, k, value in zip(batch, kinds, row):
+                values.append(convert(k, value))
+            if counter % rows_per_batch == 0:
+                if progress is not None:
+                    progress(counter)
+                yield batch
+                batch = [[] for k in kinds]
+        if progress is not None:
+            progress(counter)
+        if batch[0] or counter == 0:
+            yield batch
+
+    def write(self, db, tablec, path, fmt, progress=None):
+        if fmt == 'parquet':
+            self.write_parquet(db, tablec, path, progress)
+        else:
+            self.write_npz(db, tablec, path, progress)
+
+    def write_parquet(self, db, tablec, path, progress=None):
+        columns, kinds, sqlquery = self.columns(tablec)
+        types = {
+            'id': pyarrow.int64(),
+            'date': pyarrow.date32(),
+            'number': pyarrow.float64(),
+            'category': pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+            'text': pyarrow.string(),
+            'timestamp': pyarrow.timestamp('s'),
+        }
+        schema = pyarrow.schema([pyarrow.field(name, types[k]) for name, k in zip(columns, kinds)])
+        writer = pyarrow.parquet.ParquetWriter(
+            path, schema, compression=getattr(settings, 'EASYNUT_PARQUET_COMPRESSION', 'snappy'))
+        try:
+            for batch in self.batches(db, tablec, kinds, sqlquery, self.rows_per_batch, progress):
+                arrays = []
+                for k, values in zip(kinds, batch):
+                    if k == 'category':
+                        arrays.append(pyarrow.array(values, type=pyarrow.string()).dictionary_encode())
+                    else:
+                        arrays.append(pyarrow.array(values, type=types[k]))
+                writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+        finally:
+            writer.close()
+
+    def write_npz(self, db, tablec, path, progress=None):
+        columns, kinds, sqlquery = self.columns(tablec)
+        data = [[] for k in kinds]
+        for batch in self.batches(db, tablec, kinds, sqlquery, self.rows_per_batch, progress):
+            for values, batch_values in zip(data, batch):
+                values.extend(batch_values)
+        arrays = {
+            'columns': numpy.array([to_text(name) for name in columns]),
+            'kinds': numpy.array(kinds),
+        }
+        for i, (k, values) in enumerate(zip(kinds, data)):
+            name = 'c{}'.format(i)
+            if k == 'id':
+                arrays[name] = numpy.array(values, dtype='int64')
+            elif k == 'date':
+                arrays[name] = numpy.array(['NaT' if v is None else v.isoformat() for v in values],
+                                           dtype='datetime64[D]')
+            elif k == 'timestamp':
+                arrays[name] = numpy.array(['NaT' if v is None else v.replace(microsecond=0).isoformat()
+                                            for v in values], dtype='datetime64[s]')
+            elif k == 'number':
+                arrays[name] = numpy.array([numpy.nan if v is None else v for v in values], dtype='float64')
+            elif k == 'category':
+                categories = sorted(set(v for v in values if v is not None))
+                codes = dict((category, code) for code, category in enumerate(categories))
+                arrays[name] = numpy.array([-1 if v is None else codes[v] for v in values], dtype='int32')
+                arrays[name + '_categories'] = numpy.array(categories, dtype='U')
+            else:
+                arrays[name] = numpy.array(['' if v is None else v for v in values], dtype='U')
+                arrays[name + '_null'] = numpy.array([v is None for v in values], dtype=bool)
+        # The name of the file is kept as given (savez adds .npz otherwise)
+        with open(path, 'wb') as fh:
+            numpy.savez_compressed(fh, **arrays)
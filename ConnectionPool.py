@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Pool of connections to the easynutdata DB, shared by DAO, ExternalFields and ExternalExport
+# Each thread leases one connection the first time it needs it and gives it back
+# to the pool when the request is finished.
+
+from __future__ import unicode_literals
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.dispatch import receiver
+
+from MySQLdb import converters
+import MySQLdb
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+
+    # name: DB to connect to instead of the one of DATABASES['data'], on the same server
+    def __init__(self, name=None):
+        self.name = name
+        self.cond = threading.Condition()
+        self.local = threading.local()
+        # Idle connections with the time they were given back
+        self.idle = []
+        # Connections opened by the pool, idle or in use
+        self.open = 0
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'discarded': 0,
+        }
+
+    # Maximum number of open connections
+    @staticmethod
+    def size():
+        return getattr(settings, 'EASYNUT_POOL_SIZE', 10)
+
+    # Seconds to wait for a free connection
+    @staticmethod
+    def timeout():
+        return getattr(settings, 'EASYNUT_POOL_TIMEOUT', 10)
+
+    # Connections idle for longer than this are checked before being reused
+    @staticmethod
+    def ping_after():
+        return getattr(settings, 'EASYNUT_POOL_PING_AFTER', 60)
+
+    def connect(self):
+        conv = converters.conversions.copy()
+        conv[246] = float  # convert decimals to floats
+        conv[10] = str  # convert dates
+        return MySQLdb.connect(settings.DATABASES['data']['HOST'],
+                               settings.DATABASES['data']['USER'],
+                               settings.DATABASES['data']['PASSWORD'],
+                               self.name or settings.DATABASES['data']['NAME'], conv=conv)
+
+    # Take a connection out of the pool, waiting if all of them are in use
+    # Without wait, returns None if all of them are in use
+    def checkout(self, wait=True):
+        conn = None
+        last_used = 0
+        deadline = time.time() + self.timeout()
+        with self.cond:
+            while True:
+                if self.idle:
+                    conn, last_used = self.idle.pop()
+                    self.stats['hits'] += 1
+                    break
+                if self.open < self.size():
+                    self.open += 1
+                    self.stats['misses'] += 1
+                    break
+                if not wait:
+                    return None
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeout('No DB connection available after {} seconds'.format(self.timeout()))
+                self.stats['waits'] += 1
+                self.cond.wait(remaining)
+        # Health check of the reused connections
+        if conn is not None and time.time() - last_used > self.ping_after():
+            try:
+                conn.ping()
+            except MySQLdb.Error:
+                self.stats['discarded'] += 1
+                conn = None
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self.cond:
+                    self.open -= 1
+                    self.cond.notify()
+                raise
+        return conn
+
+    # Give a connection back to the pool
+    def checkin(self, conn):
+        try:
+            # Ends the transaction, so the next user does not read an old snapshot
+            conn.rollback()
+        except MySQLdb.Error:
+            conn = None
+        with self.cond:
+            if conn is None:
+                self.open -= 1
+                self.stats['discarded'] += 1
+            else:
+                self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    # Connection leased by the current thread
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.checkout()
+            self.local.conn = conn
+        return conn
+
+    # Give back the connection leased by the current thread
+    def release(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.local.conn = None
+            self.checkin(conn)
+
+    # Run func(conn, item) for all the items and return the results in the same order
+    # The items are spread over the connection of the current thread and up to
+    # EASYNUT_POOL_WORKERS extra connections, each used by its own thread.
+    # Only free connections are taken, so this never waits for the pool.
+    def map(self, func, items, workers=None):
+        items = list(items)
+        if workers is None:
+            workers = getattr(settings, 'EASYNUT_POOL_WORKERS', 4)
+        extra = []
+        while len(extra) < min(workers, len(items) - 1):
+            conn = self.checkout(wait=False)
+            if conn is None:
+                break
+            extra.append(conn)
+        conns = [self.connection()] + extra
+        results = [None] * len(items)
+        errors = []
+
+        def work(conn, indexes):
+            try:
+                for i in indexes:
+                    results[i] = func(conn, items[i])
+            except Exception as e:
+                errors.append(e)
+
+        threads = []
+        for n, conn in enumerate(extra, 1):
+            thread = threading.Thread(target=work, args=(conn, range(n, len(items), len(conns))))
+            thread.start()
+            threads.append(thread)
+        work(conns[0], range(0, len(items), len(conns)))
+        for thread in threads:
+            thread.join()
+        for conn in extra:
+            self.checkin(conn)
+        if errors:
+            raise errors[0]
+        return results
+
+    def get_stats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats['open'] = self.open
+            stats['idle'] = len(self.idle)
+            stats['in_use'] = self.open - len(self.idle)
+        return stats
+
+
+pool = ConnectionPool()
+
+
+# Per-request checkout / return
+@receiver(request_finished)
+def releaseConnection(sender, **kwargs):
+    pool.release()
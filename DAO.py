@@ -3,21 +3,44 @@
 
 from __future__ import print_function, unicode_literals
 from collections import defaultdict
-from datetime import date
+from functools import wraps
 from operator import itemgetter
-import csv
 import os
 import re
 import shutil
 
 from django.conf import settings
 
-from MySQLdb import converters
 import MySQLdb
 
+from .ConnectionPool import pool
 from .EasyDBObjects import TableConfig, FieldConfig
+from .Exporter import Exporter, change_log, dataclean
 from .ExternalExport import ExternalExport
-from .ExternalFields import ExternalFields
+from .ExternalFields import ExternalFields, registry
+from .GrowthCharts import growth_charts
+from .MsfIds import msf_id_allocator, msf_id_resolver
+from .PatientSummary import patient_summary
+from .Permissions import permissions
+from .QueryBuilder import queries, identifier, like_escape
+from .SchemaRegistry import schema_registry
+from .SearchIndex import get_search_index
+
+
+# Keep the result of a DAO method for the lifetime of the DAO object (one request),
+# keyed by the method and its arguments
+def memoize(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        if key in self.memo:
+            self.memo_hits += 1
+        else:
+            self.memo_misses += 1
+            self.memo[key] = method(self, *args, **kwargs)
+        return self.memo[key]
+    return wrapper
+
 
 class DAO(object):
 
@@ -33,61 +56,48 @@ class DAO(object):
         self.easy_user = {}
         # graphs
         self.graphs = []
+        # Results of the memoized methods
+        self.memo = {}
+        self.memo_hits = 0
+        self.memo_misses = 0
+        # Runner of the custom calculations, created when one applies
+        self.external_fields = None
 
         # Initiate DB
-        conv = converters.conversions.copy()
-        conv[246] = float  # convert decimals to floats
-        conv[10] = str  # convert dates
-        self.db = MySQLdb.connect(settings.DATABASES['data']['HOST'],
-                                  settings.DATABASES['data']['USER'],
-                                  settings.DATABASES['data']['PASSWORD'],
-                                  settings.DATABASES['data']['NAME'], conv=conv)
+        self.db = pool.connection()
 
     # Create list of configurations of each forms
     def set_tables_config(self):
+        self.tables_config = []
         # Get a list of all tables
         c = self.db.cursor()
-        sql_tables = 'select tabla_id, presentador from tablas'
+        sql_tables = 'select tabla_id, presentador, registros from tablas'
         c.execute(sql_tables)
-        self.tables_config_lite = c.fetchall()
+        tables = c.fetchall()
+        self.tables_config_lite = tuple((k, v) for k, v, position in tables)
         # Loop through them to prepare the list
-        for k, v in self.tables_config_lite:
+        for k, v, position in tables:
             # Initiate form object and get its respective fields
             tablec = {}
             tablec['id'] = k
             tablec['name'] = v
+            # Position of the form in the patient page
+            tablec['position'] = int(position)
             tablec['sql_table_config_name'] = 'tabla_' + str(k)
             tablec['sql_table_field_config_name'] = tablec['sql_table_config_name'] + '_des'
             tablec['fields'] = []
-            sql_fields = 'SELECT _id FROM {}'  # FROM table{tabla_id}_des
-            params = (tablec['sql_table_field_config_name'],)
+            # Read the whole field configuration of the form in one query
+            # instead of one query per field and per attribute
+            attributes = FieldConfig.attributes.items()
+            sql_fields = 'SELECT {} FROM {}'  # FROM table{tabla_id}_des
+            params = (', '.join([attributek for attributek, attributev in attributes]),
+                      tablec['sql_table_field_config_name'],)
             c.execute(sql_fields.format(*params))
             # Loop through the fields
-            fieldc = FieldConfig()
-            for field_id in c.fetchall():
-                # Initiate field object and loop through its atributes
+            for row in c.fetchall():
                 fielddic = {}
-                for attributek, attributev in fieldc.attributes.items():
-                    sql_field_config = 'select {} from {} where _id = {}'  # FROM table{tabla_id}_des
-                    params = (attributek, tablec['sql_table_field_config_name'], field_id[0],)
-                    c.execute(sql_field_config.format(*params))
-                    sqlresult = c.fetchone()[0]
-                    # *TBC*#
-                    # Convert the attributes for the field object
-                    # This stupid conversion is due to a change of DB model
-                    # Needs to be cleaned
-                    if sqlresult in fieldc.hasmapft.keys():
-                        fielddic[attributev] = fieldc.hasmapft[sqlresult]
-                    elif sqlresult in fieldc.field_types.keys():
-                        fielddic[attributev] = fieldc.field_types[sqlresult]
-                    elif attributev == 'select':
-                        selectlist = []
-                        if sqlresult is not None:
-                            for tostrip in sqlresult.split(','):
-                                selectlist.append(tostrip.strip())
-                        fielddic[attributev] = selectlist
-                    else:
-                        fielddic[attributev] = sqlresult
+                for (attributek, attributev), sqlresult in zip(attributes, row):
+                    fielddic[attributev] = FieldConfig.convert_attribute(attributev, sqlresult)
                 tablec['fields'].append(fielddic)
                 del fielddic
             self.tables_config.append(tablec)
@@ -97,32 +107,19 @@ class DAO(object):
 #            myFile.write(json.dumps(self.tables_config, indent=4))
         return self.tables_config
 
+    # Get the configurations of the forms from the process-wide registry
+    # Returns the version of the schema
+    def load_tables_config(self):
+        return schema_registry.load(self)
+
     # Get graphos-ready data for graphed fields
-    def set_graphs(self, record_id):
-        c = self.db.cursor()
-        graphlist = []
-
-        for tb in self.tables_config:
-            for fi in tb['fields']:
-                if not (fi['type'] == FieldConfig.field_type_int and fi['select'] and 'grafico:' in fi['select'][0]):
-                    continue  # only int fields with select
-
-                xaxisfield = fi['select'][0][8:]
-                xaxisname = [fix['name'] for fix in tb['fields'] if fix['field'] == fi['select'][0][8:]][0]
-                yaxisfield = fi['field']
-                yaxisname = fi['name']
-                sqlquery = 'SELECT 1000 * UNIX_TIMESTAMP({}), {} FROM {} ' \
-                           'WHERE campo_2 IN ( SELECT campo_1 FROM tabla_1 WHERE _id = {} ) ' \
-                           'ORDER BY ' + xaxisfield
-                params = [xaxisfield, yaxisfield, tb['sql_table_config_name'], record_id]
-                c.execute(sqlquery.format(*params))
-
-                graphlist = [[xaxisname, yaxisname]]  # first row contains column names, per django-graphos convention
-                for rec in c.fetchall():
-                    graphlist.append(list(rec))  # add rest of data columns
-                self.graphs.append([tb['id'], xaxisname, yaxisname, graphlist])  # add graph
-        c.close()
-        return graphlist
+    # Only the points between start and end (timestamps in ms), downsampled to max_points if given
+    def set_graphs(self, record_id, start=None, end=None, max_points=None):
+        msfId = msf_id_resolver.msf_id(self.db, record_id)
+        self.graphs = growth_charts.series(self.db, self.tables_config, msfId)
+        if start is not None or end is not None or max_points:
+            self.graphs = [growth_charts.window(graph, start, end, max_points) for graph in self.graphs]
+        return self.graphs
 
     # *TBC*#
     # Defines the replationships between the tables
@@ -163,113 +160,134 @@ class DAO(object):
         # *TBC*#
         # No need of the loop anymore
         for tablec in filtered_tables:
-            query = self.search_query(entryList, tablec) + ' ORDER BY campo_1 DESC, timestamp DESC limit 100'
+            query, params = self.search_query(entryList, tablec)
+            query += ' ORDER BY campo_1 DESC, timestamp DESC limit 100'
             results = [tablec['name'], tablec['id']] + [map(lambda f: f['name'], filter(lambda f: f['list'], tablec['fields']))]
-            c.execute(query)
+            c.execute(query, params)
             results.append(c.fetchall())
             all_results.append(self.launchExternalFields(results))
         returnList.append(all_results)
         c.close()
         return returnList
 
-    # Define the sql query for the search function
+    # Define the sql query for the search function, and its parameters
+    # Uses the search index if there is one, otherwise looks for the keywords in every field
     def search_query(self, search_params, tablec):
         query = 'select {} from {} where '.format(
             ', '.join(['_id'] + (map(lambda f: f['field'], filter(lambda f: f['list'], tablec['fields'])))),
             tablec['sql_table_config_name']
         )
         where_string = []
+        params = []
+        index = get_search_index(self.db, self.tables_config)
         for search_param in search_params:
-            param_clause = '(' \
-                + ' or '.join(map(lambda f: self.search_condition(f, search_param), tablec['fields'])) \
-                + ')'
+            condition = index.condition(tablec['id'], search_param) if index is not None else None
+            if condition is not None:
+                param_clause, param_params = condition
+                params += param_params
+            else:
+                # No index, or a keyword without any word to look up in it
+                conditions = [self.search_condition(f, search_param) for f in tablec['fields']]
+                param_clause = '(' + ' or '.join(clause for clause, clause_params in conditions) + ')'
+                params += [param for clause, clause_params in conditions for param in clause_params]
             where_string.append(param_clause)
 
         query += ' and '.join(where_string)
 
-        return query
+        return query, params
 
     # Define the SQL fields to search in
     def search_by_fields(self, tablec, search_params, showall):
         where_string = []
+        params = []
         for search_param in search_params:
-            where_string.append(
-                self.search_condition(search_params[search_param]['fieldc'],
-                search_params[search_param]['value'])
-            )
+            clause, clause_params = self.search_condition(search_params[search_param]['fieldc'],
+                                                          search_params[search_param]['value'])
+            where_string.append(clause)
+            params += clause_params
 
         query = "select {} from {} where {}".format(self.select_string(tablec, showall),
                                                     tablec['sql_table_config_name'],
                                                     ' and '.join(where_string))
 
         c = self.db.cursor()
-        c.execute(query)
+        c.execute(query, params)
         rows = c.fetchall()
         fields = map(lambda x: x[0], c.description)
         results = [dict(zip(fields, row)) for row in rows]
         c.close()
         return results
 
-    # Define the sql conditions to search in
+    # Define the sql conditions to search in, and their parameters
     @staticmethod
     def search_condition(fieldc, value):
         if fieldc['type'] == 1 and value and isinstance(value, (int, long)):
-            return '{} = {}'.format(fieldc['field_id'], value)
+            return queries.condition(fieldc['field_id'], '='), [value]
         elif fieldc['type'] == 0 and value != 'NULL':
-            return '{} = STR_TO_DATE(\'{}\', "%Y-%m-%d")'.format(fieldc['field_id'], value)
+            return queries.condition(fieldc['field_id'], 'date'), [value]
         else:
-            return '{} like \'%{}%\''.format(fieldc['field_id'], value)
+            return queries.condition(fieldc['field_id'], 'LIKE'), ['%' + like_escape('{}'.format(value)) + '%']
 
     # Gest a specific record (form answers) with additional info
+    @memoize
     def get_record_with_type(self, table_id, record_id, listFields):
         c = self.db.cursor()
         record = [table_id, record_id]
         recorddetails = []
         patientId = '0'
-        # *TBC*#
-        # Lot of nested loops. Ugly
+        # Values of the custom calculations folded into the query
+        values = {}
         for tablec in self.tables_config:
             if tablec['id'] == table_id:
                 record.append(tablec['name'])
-                for fieldc in tablec['fields']:
-                    if (listFields and fieldc['list']) or (not listFields):
-                        sqlquery = 'select {} from {} where _id = {}'
-                        params = [fieldc['field'], tablec['sql_table_config_name'], record_id]
-                        c.execute(sqlquery.format(*params))
-                        result = c.fetchone()[0]
-                        if fieldc['name'] == 'MSF ID':
-                            patientId = self.getPatientIdFromMsfId(result)
-                        recorddetails.append([
-                            fieldc['field_id'],
-                            fieldc['type'],
-                            fieldc['pos'],
-                            fieldc['name'],
-                            result,
-                            fieldc['select'],
-                            ])
+                fields = [fieldc for fieldc in tablec['fields'] if (listFields and fieldc['list']) or (not listFields)]
+                msfFields = [fieldc['field'] for fieldc in fields if fieldc['name'] == 'MSF ID']
+                folded = []
+                if listFields:
+                    plugins = registry.plugins('single', table_id, [fieldc['name'] for fieldc in fields])
+                    folded = registry.select(plugins, self.tables_config,
+                                             'r.' + msfFields[0] if msfFields else 'NULL')
+                # Fetch the whole record in one query,
+                # with the DB ID of the patient joined on the MSF ID
+                # and what the custom calculations need
+                sqlquery = 'SELECT {} FROM {} r '
+                params = [', '.join(['r.' + fieldc['field'] for fieldc in fields] + ['p._id' if msfFields else 'NULL']
+                                    + [expression + ' AS ' + alias for alias, expression in folded]),
+                          tablec['sql_table_config_name']]
+                if msfFields:
+                    sqlquery += 'LEFT JOIN tabla_1 p ON p.campo_1 = r.{} '
+                    params.append(msfFields[0])
+                sqlquery += 'WHERE r._id = %s LIMIT 1'
+                c.execute(sqlquery.format(*params), [record_id])
+                row = c.fetchone() or [None] * (len(fields) + 1 + len(folded))
+                values = dict(zip([alias for alias, expression in folded], row[len(fields) + 1:]))
+                if msfFields and row[len(fields)] is not None:
+                    patientId = row[len(fields)]
+                    msfId = [result for fieldc, result in zip(fields, row) if fieldc['field'] == msfFields[0]][0]
+                    msf_id_resolver.remember(msfId, patientId)
+                for fieldc, result in zip(fields, row):
+                    recorddetails.append([
+                        fieldc['field_id'],
+                        fieldc['type'],
+                        fieldc['pos'],
+                        fieldc['name'],
+                        result,
+                        fieldc['select'],
+                        ])
         record.append(sorted(recorddetails, key=itemgetter(2)))
         record.append(patientId)
         c.close()
-        # *TBC*#
         # If this is not a form but just displaying the data,
         # launch the custom calculations.
-        # There might be a much better way to have custom calculations...
         if listFields:
-            return self.launchSingleExternalFields(record)
+            return self.launchSingleExternalFields(record, values)
         return record
 
     # Basic function to obtain the DB ID of the patient from the MSF ID
     def getPatientIdFromMsfId(self, msfid):
-        c = self.db.cursor()
-        sqlquery = 'SELECT _id FROM tabla_1 WHERE campo_1 LIKE {}'
-        params = ['"%{}%"'.format(msfid)]
-        c.execute(sqlquery.format(*params))
-        result = c.fetchone()
-        if result:
-            ID = result[0]
-        else:
+        ID = msf_id_resolver.patient_id(self.db, msfid)
+        if ID is None:
             ID = '0'
-        c.close()
         return ID
 
     # Insert a record (answers from a form)
@@ -283,86 +301,181 @@ class DAO(object):
             for field in fieldstoadd:
                 if field[0] == 'campo_1':
                     field[1] = self.getNewId('tabla_1', 'campo_1')
-        # *TBC*#
-        # Lost of nested loops
         for tablec in self.tables_config:
             if tablec['id'] == table_id:
-                fields = []
-                values = []
-                for field in fieldstoadd:
-                    fields.append(field[0])
-                    if field[1] == '' or field[1] is None:
-                        values.append('NULL')
-                    elif field[2] == 1:
-                        values.append('{}'.format(field[1]))
-                    elif field[2] == 0 and field[1] != 'NULL':
-                        values.append('STR_TO_DATE("{}", "%Y-%m-%d")'.format(field[1]))
-                    else:
-                        values.append('\'{}\''.format(self.datacleansingle(field[1])))
-                query = 'insert into {} ({}) values ({})'.format(tablec['sql_table_config_name'],
-                                                                 ', '.join(fields),
-                                                                 ', '.join(values))
+                query = queries.insert(tablec['sql_table_config_name'],
+                                       [(field[0], field[2] == 0) for field in fieldstoadd])
                 c = self.db.cursor()
-                c.execute(query)
+                c.execute(query, [self.sql_value(field) for field in fieldstoadd])
                 record_id = c.lastrowid
+                change_log.record(self.db, table_id, record_id, 'insert')
+                self.refresh_search_index(tablec, record_id)
+                msfIds = self.patient_msf_ids(table_id, record_id)
+                self.refresh_patient_summary(msfIds)
                 self.db.commit()
+                growth_charts.invalidate(table_id, msfIds)
+                if table_id == '1':
+                    msf_id_resolver.remember([field[1] for field in fieldstoadd if field[0] == 'campo_1'][0], record_id)
+                    msf_id_allocator.inserted([field[1] for field in fieldstoadd if field[0] == 'campo_1'])
                 # record_id2 = c.lastrowid
                 c.close()
                 # record_id_3 = record_id
+        self.memo.clear()
         return record_id
 
+    # Insert many records of a form at once
+    # rows: list of the fields of each record, as for insertrecord ([field, value, type])
+    # The rows are inserted by chunks, each in its own transaction, with multi-row INSERTs.
+    # If a chunk fails, its rows are inserted one by one to find the ones in error, the others are kept.
+    # Returns the number of records inserted and the errors, as a list of (index of the row, error)
+    def bulk_insert(self, table_id, rows, chunk_size=500):
+        tables = [tablec for tablec in self.tables_config if tablec['id'] == table_id]
+        if not tables:
+            raise ValueError('Unknown form: {}'.format(table_id))
+        tablec = tables[0]
+        # New patients without MSF ID get the next ones, reserved in one block
+        if table_id == '1':
+            msf_id_allocator.ensure(self.db)
+            missing = [field for fieldstoadd in rows for field in fieldstoadd if field[0] == 'campo_1' and not field[1]]
+            for field, msfId in zip(missing, msf_id_allocator.reserve(self.db, len(missing))):
+                field[1] = msfId
+        inserted = 0
+        errors = []
+        msfIds = set()
+        firstId = self.lastRecordId(tablec)
+        c = self.db.cursor()
+        for start in range(0, len(rows), chunk_size):
+            chunk = list(enumerate(rows[start:start + chunk_size], start))
+            # One statement per set of columns
+            shapes = defaultdict(list)
+            for index, fieldstoadd in chunk:
+                shapes[tuple((field[0], field[2] == 0) for field in fieldstoadd)].append(fieldstoadd)
+            sinceId = self.lastRecordId(tablec)
+            try:
+                for shape, shaperows in shapes.items():
+                    c.execute(queries.insert_many(tablec['sql_table_config_name'], shape, len(shaperows)),
+                              [self.sql_value(field) for fieldstoadd in shaperows for field in fieldstoadd])
+                change_log.record_new(self.db, tablec, sinceId)
+                self.db.commit()
+                inserted += len(chunk)
+                done = chunk
+            except MySQLdb.Error:
+                self.db.rollback()
+                done = []
+                for index, fieldstoadd in chunk:
+                    try:
+                        c.execute(queries.insert(tablec['sql_table_config_name'],
+                                                 [(field[0], field[2] == 0) for field in fieldstoadd]),
+                                  [self.sql_value(field) for field in fieldstoadd])
+                        change_log.record(self.db, table_id, c.lastrowid, 'insert')
+                        inserted += 1
+                        done.append((index, fieldstoadd))
+                    except MySQLdb.Error as e:
+                        errors.append((index, '{}'.format(e)))
+                self.db.commit()
+            msfIds |= set(field[1] for index, fieldstoadd in done for field in fieldstoadd
+                          if field[0] == ('campo_1' if table_id == '1' else 'campo_2') and field[1])
+        c.close()
+        if table_id == '1':
+            msf_id_allocator.seen(self.db, msfIds)
+            self.db.commit()
+            msf_id_allocator.inserted(list(msfIds))
+        self.refresh_after_bulk_insert(tablec, msfIds, firstId)
+        self.memo.clear()
+        return inserted, errors
+
+    # Highest DB ID of the records of a form, the records added after have higher ones
+    def lastRecordId(self, tablec):
+        c = self.db.cursor()
+        c.execute(queries.statement(('lastRecordId', tablec['sql_table_config_name']), lambda: (
+            'SELECT COALESCE(MAX(_id), 0) FROM {}'.format(identifier(tablec['sql_table_config_name'])))))
+        lastId = c.fetchone()[0]
+        c.close()
+        return lastId
+
+    # Keep the search index, the summary of the patients and the charts up to date after a bulk insert
+    # The records inserted are the ones after the record firstId
+    def refresh_after_bulk_insert(self, tablec, msfIds, firstId):
+        index = get_search_index(self.db, self.tables_config)
+        if index is not None:
+            index.index_new(self.db, tablec, firstId)
+            self.db.commit()
+        if patient_summary.enabled():
+            if len(msfIds) > 100:
+                patient_summary.rebuild(self.db, self.tables_config)
+            else:
+                self.refresh_patient_summary(msfIds)
+                self.db.commit()
+        growth_charts.invalidate(tablec['id'], msfIds)
+
+    # Value of a field to save, from [field, value, type]
+    # Empty values are saved as NULL
+    # *TBC*#
+    # 'NULL' is also NULL for the dates and numbers, but it is kept as text in the text fields as it always was
+    @staticmethod
+    def sql_value(field):
+        if field[1] == '' or field[1] is None or (field[1] == 'NULL' and field[2] in (0, 1)):
+            return None
+        return field[1]
+
     # Edit a record (form answers)
     def editrecord(self, table_id, record_id, fieldstochange):
-        sqlquery = 'UPDATE {} SET'
+        # Before the transaction of the edit, see MsfIdAllocator.seen
+        if table_id == '1':
+            msf_id_allocator.ensure(self.db)
+        msfIds = self.patient_msf_ids(table_id, record_id)
         c = self.db.cursor()
-        # *TBC*#
-        # Loop just to obtain the name of the table in the DB
         for tablec in self.tables_config:
             if tablec['id'] == table_id:
-                params = [tablec['sql_table_config_name'], ]
-        # *TBC*#
-        # According to the type of the field
-        # There should be a proper way to handle that
-        for counter, field in enumerate(fieldstochange):
-            if field[1]:
-                value1 = field[1].replace("'", "")
-                value2 = value1.replace('"', '')
-            else:
-                value2 = field[1]
-            if value2 == '':
-                value2 = 'NULL'
-            if counter == 0:
-                if field[2] == 1:
-                    sqlquery += ' {} = {}'
-                elif field[2] == 0:
-                    if value2 != 'NULL':
-                        sqlquery += ' {} = STR_TO_DATE("{}", "%Y-%m-%d")'
-                    else:
-                        sqlquery += ' campo_1 = NULL'
-                else:
-                    sqlquery += ' {} = "{}"'
-            else:
-                if field[2] == 1:
-                    sqlquery += ', {} = {}'
-                elif field[2] == 0:
-                    if value2 != 'NULL':
-                        sqlquery += ', {} = STR_TO_DATE("{}", "%Y-%m-%d")'
-                else:
-                    sqlquery += ', {} = "{}"'
-            if field[2] == 0:
-                if value2 != 'NULL':
-                    params.append(field[0])
-                    params.append(self.datacleansingle(value2))
-            else:
-                params.append(field[0])
-                params.append(self.datacleansingle(value2))
-        sqlquery += ' WHERE _id = {}'
-        params.append(record_id)
-        c.execute(sqlquery.format(*params))
+                sqlquery = queries.update(tablec['sql_table_config_name'],
+                                          [(field[0], field[2] == 0) for field in fieldstochange])
+        c.execute(sqlquery, [self.sql_value(field) for field in fieldstochange] + [record_id])
+        change_log.record(self.db, table_id, record_id, 'edit')
+        for tablec in self.tables_config:
+            if tablec['id'] == table_id:
+                self.refresh_search_index(tablec, record_id)
+        msfIds += self.patient_msf_ids(table_id, record_id)
+        self.refresh_patient_summary(msfIds)
+        if table_id == '1':
+            msf_id_allocator.seen(self.db, [field[1] for field in fieldstochange if field[0] == 'campo_1'])
         self.db.commit()
+        growth_charts.invalidate(table_id, msfIds)
         c.close()
+        if table_id == '1':
+            msf_id_resolver.forget(record_id)
+            msf_id_allocator.forget_last()
+        self.memo.clear()
         return
 
+    # Keep the search index up to date after a record is added or edited
+    def refresh_search_index(self, tablec, record_id):
+        index = get_search_index(self.db, self.tables_config)
+        if index is not None:
+            index.refresh(self.db, tablec, record_id)
+
+    # MSF ID of the patient of a record, as a list,
+    # if the summary of the patients is used or the form has charts
+    def patient_msf_ids(self, table_id, record_id):
+        if not patient_summary.enabled() and not growth_charts.has_graphs(self.tables_config, table_id):
+            return []
+        row = None
+        c = self.db.cursor()
+        for tablec in self.tables_config:
+            if tablec['id'] == table_id:
+                # The MSF ID is campo_1 in the Bio data and campo_2 in the other forms
+                sqlquery = queries.select(tablec['sql_table_config_name'],
+                                          ['campo_1' if table_id == '1' else 'campo_2'], [('_id', '=')])
+                c.execute(sqlquery, [record_id])
+                row = c.fetchone()
+        c.close()
+        return [row[0]] if row and row[0] else []
+
+    # Keep the summary of the patients up to date after a record is added, edited or deleted
+    def refresh_patient_summary(self, msfIds):
+        if patient_summary.enabled():
+            for msfId in set(msfIds):
+                patient_summary.refresh(self.db, msfId, self.tables_config)
+
     # Get the form to apply for the specified table
     # Used when adding a new record
     def getrecordform(self, table_id):
@@ -384,24 +497,34 @@ class DAO(object):
 
     # Delete a specific record
     def delete(self, table_id, record_id):
+        msfIds = self.patient_msf_ids(table_id, record_id)
         c = self.db.cursor()
-        sqlquery = 'DELETE FROM {} WHERE _id = {}'
         for tablec in self.tables_config:
             if tablec['id'] == table_id:
-                params = [tablec['sql_table_config_name'], record_id]
-        c.execute(sqlquery.format(*params))
+                sqlquery = queries.delete(tablec['sql_table_config_name'])
+        c.execute(sqlquery, [record_id])
+        index = get_search_index(self.db, self.tables_config)
+        if index is not None:
+            index.remove(self.db, table_id, record_id)
+        change_log.record(self.db, table_id, record_id, 'delete')
+        self.refresh_patient_summary(msfIds)
         self.db.commit()
+        growth_charts.invalidate(table_id, msfIds)
         c.close()
+        if table_id == '1':
+            msf_id_resolver.forget(record_id)
+            msf_id_allocator.forget_last()
+        self.memo.clear()
         return
 
     # Used in REST Api
     def select_from_record_id(self, table_id, record_id, showall=True):
         c = self.db.cursor()
-        sqlquery = 'select {} from {} where _id = {}'
+        sqlquery = 'select {} from {} where _id = %s'
         for tablec in self.tables_config:
             if tablec['id'] == table_id:
-                params = [self.select_string(tablec, showall), tablec['sql_table_config_name'], record_id]
-                c.execute(sqlquery.format(*params))
+                params = [self.select_string(tablec, showall), tablec['sql_table_config_name']]
+                c.execute(sqlquery.format(*params), [record_id])
                 record = c.fetchone()
                 if record is not None:
                     fields = map(lambda x: x[0], c.description)
@@ -420,125 +543,80 @@ class DAO(object):
 
     # *TBC*#
     # Get the records of a specific patient that are not bio data
+    # The forms are queried in parallel on the connections of the pool
+    @memoize
     def get_related_records(self, record_id):
-        c = self.db.cursor()
-        relatedrecords = []
-        templist = []
-        for tablec in self.tables_config:
-            if self.easy_user['tables'][tablec['id']]['view_table'] and tablec['id'] != '1':
-                sqlquery = 'SELECT campo_1 FROM tabla_1 WHERE _id = {}'
-                params = [record_id]
-                c.execute(sqlquery.format(*params))
-                msfId = c.fetchone()[0]
-                sqlquery = 'SELECT registros FROM tablas WHERE tabla_id = {}'
-                params = [tablec['id']]
-                c.execute(sqlquery.format(*params))
-                position = c.fetchone()[0]
-                templist.append([self.getRelatedSearch(msfId, tablec['id']), int(position)])
-        c.close()
-        for recordsList in sorted(templist, key=itemgetter(1)):
-            relatedrecords.append(recordsList[0])
-        return relatedrecords
+        msfId = msf_id_resolver.msf_id(self.db, record_id)
+        tables = [tablec for tablec in self.tables_config
+                  if self.easy_user['tables'][tablec['id']]['view_table'] and tablec['id'] != '1']
+        tables.sort(key=itemgetter('position'))
+        rows = pool.map(lambda conn, tablec: self.fetchall(conn, *self.related_query(msfId, tablec)), tables)
+        # With the permissions of the user on the form, for the template
+        return [self.related_results(msfId, tablec, tablerows) + [self.easy_user['tables'][tablec['id']]]
+                for tablec, tablerows in zip(tables, rows)]
 
     # See up
     def getRelatedSearch(self, entry, table_id):
-        c = self.db.cursor()
-        usersearch = [entry]
-        returnList = []
-        all_results = []
-        search_query = ''
         for tablec in self.tables_config:
             if table_id == tablec['id']:
-                usersearch.append(tablec['name'])
-                search_query = 'SELECT _id'
-                for field in tablec['fields']:
-                    if field['list'] is True:
-                        relatedrecords = [tablec['name'], tablec['id']] \
-                            + [map(lambda f: f['name'], filter(lambda f: f['list'], tablec['fields']))]
-                        search_query += ','+field['field_id']
-                search_query += ' FROM ' + tablec['sql_table_config_name'] \
-                    + ' WHERE campo_2 = "' + entry + '" ORDER BY campo_1 DESC'
-        if search_query != '':
-            c.execute(search_query)
-            relatedrecords.append(c.fetchall())
-            all_results.append(self.launchExternalFields(relatedrecords))
-            returnList.append(usersearch)
-            returnList.append(all_results)
-        return returnList
+                return self.related_results(entry, tablec, self.fetchall(self.db, *self.related_query(entry, tablec)))
+        return []
 
-    # Get last ID inserted
-    def getLastId(self, table_id, column_name):
-        c = self.db.cursor()
-        sqlquery = 'SELECT MAX({}) FROM {}'
-        params = [column_name, table_id]
-        c.execute(sqlquery.format(*params))
-        highestId = c.fetchone()[0]
+    # Query of the records of a patient in a form, and its parameters
+    @staticmethod
+    def related_query(entry, tablec):
+        fields = [field['field_id'] for field in tablec['fields'] if field['list'] is True]
+        sqlquery = queries.select(tablec['sql_table_config_name'], ['_id'] + fields, [('campo_2', '=')],
+                                  order_by=['campo_1 DESC'])
+        return sqlquery, [entry]
+
+    # Results of the records of a patient in a form, with the custom calculations
+    def related_results(self, entry, tablec, rows):
+        relatedrecords = [tablec['name'], tablec['id']] \
+            + [map(lambda f: f['name'], filter(lambda f: f['list'], tablec['fields']))]
+        relatedrecords.append(rows)
+        return [[entry, tablec['name']], [self.launchExternalFields(relatedrecords)]]
+
+    @staticmethod
+    def fetchall(db, sqlquery, params=None):
+        c = db.cursor()
+        c.execute(sqlquery, params)
+        rows = c.fetchall()
         c.close()
-        if highestId:
-            return highestId
-        else:
-            return 0
+        return rows
+
+    # Get last MSF ID inserted, from the counter of the allocator, see MsfIds
+    def getLastMsfId(self):
+        return msf_id_allocator.last_id(self.db)
 
     # Create a new ID
+    # Only the MSF IDs (tabla_1.campo_1) are given, by the allocator, see MsfIds
     def getNewId(self, table_id, column_name):
-        lastId = self.getLastId(table_id, column_name)
-        newIdInt = int(lastId) + 1
-        newIdStr = str(newIdInt)
-        zerosToAdd = 6 - len(newIdStr)
-        IdToReturn = ''
-        for i in xrange(zerosToAdd):
-            IdToReturn = IdToReturn + '0'
-        return IdToReturn + newIdStr
+        return msf_id_allocator.reserve(self.db)[0]
 
     # Check if an ID already exists
+    # Not from the cache, as the user is redirected to the patient
     def doesIdExist(self, entry):
-        c = self.db.cursor()
-        sqlquery = 'SELECT _id FROM tabla_1 WHERE campo_1 = {} LIMIT 1'
-        params = ['"{}"'.format(entry)]
-        c.execute(sqlquery.format(*params))
-        result = c.fetchone()
-        c.close()
-        if result:
-            return result[0]
+        result = msf_id_resolver.patient_id(self.db, entry, cached=False)
+        if result is not None:
+            return result
         else:
             return False
 
     # Generate a raw export of the DB: a zip file containing csv of all tables
+    # The download streams the same zip without these files, see Exporter.stream_zip
     def generateExport(self):
-        c = self.db.cursor()
+        exporter = Exporter(self.tables_config)
         exportDir = os.path.join(settings.BASE_DIR, 'export/')
         for tablec in self.tables_config:
-            with open(exportDir+'CSVFiles/'+re.sub('[^\w\-_\. ]', '', tablec['name'])+'.csv', 'wb') as mycsv:
-                wr = csv.writer(mycsv, quoting=csv.QUOTE_ALL)                
-                columns = []
-                sqlquery= 'SELECT '
-                params = []
-                for counter, field in enumerate(tablec['fields']):
-                    if counter == (len(tablec['fields']) - 1):
-                        sqlquery = sqlquery + ', user, timestamp'
-                    else:
-                        if counter == 0:
-                            sqlquery = sqlquery + ' {}'
-                        else:
-                            sqlquery = sqlquery + ', {}'
-                        params.append(field['field_id'])
-                        columns.append(str(field['name']))
-                columns.append('User')
-                columns.append('Timestamp')
-                sqlquery = sqlquery + ' FROM {}'
-                params.append(tablec['sql_table_config_name'])
-                wr.writerow(self.dataclean(columns))
-                c.execute(sqlquery.format(*params)) 
-                for row in c.fetchall():
-                    wr.writerow(self.dataclean(row))
-        filename = 'EasyNutExport'+date.today().strftime('%d%b%Y')                     
+            exporter.write_csv(self.db, tablec, exportDir + 'CSVFiles/' + exporter.csvname(tablec))
+        filename = exporter.filename()
         zipPath = exportDir
         toZip = exportDir + 'CSVFiles'
         for f in os.listdir(exportDir):
             if re.search('^EasyNutExport([0-9a-zA-Z]+).zip', f):
                 os.remove(os.path.join(exportDir, f))
         shutil.make_archive(zipPath + filename, 'zip', toZip)
-        c.close()
         return zipPath + filename
 
     # *TBC*#
@@ -550,114 +628,44 @@ class DAO(object):
         return zippath
 
     # Define the permissions of a user
+    # Here it uses both DB, easynut (the groups of the user) and easynutdata (the roles)
+    # The permissions are compiled once per set of groups, see Permissions
     def setEasyUser(self, user):
-        # User groups (careful, this has to be linked with the Django group table)
-        # Here it uses both DB, easynut and easynutdata
-        # *TBC*#
-        # The groups (or "roles") should not be defined here
-        group_reg = 1
-        group_adm = 2
-        group_flo = 3
-        group_nur = 4
-        group_idc = 5
-        group_pha = 6
-
-        c = self.db.cursor()
-        sql_query = 'SELECT group_id, table_id, view_table, add_table, edit_table, delete_table FROM easy_roles'
-        c.execute(sql_query)
-        easy_roles = c.fetchall()
-        user_tables = {}
-
-        # Consider first that the user has no roles
-        for tclk, tclv in self.tables_config_lite:
-            user_tables[str(tclk)] = {
-                'view_table': False,
-                'add_table': False,
-                'edit_table': False,
-                'delete_table': False
-                }
-
-        # Loop first through the available roles (or "groups")
-        for role in easy_roles:
-            # Then loop through the roles the user possesses
-            for group in user.groups.all():
-                if group.id == role[0]:
-                    for utk, utv in user_tables[str(role[1])].iteritems():
-                        if utk == 'view_table' and utv is False and role[2] == 1:
-                            user_tables[str(role[1])][str(utk)] = True
-                        if utk == 'add_table' and utv is False and role[3] == 1:
-                            user_tables[str(role[1])][str(utk)] = True
-                        if utk == 'edit_table' and utv is False and role[4] == 1:
-                            user_tables[str(role[1])][str(utk)] = True
-                        if utk == 'delete_table' and utv is False and role[5] == 1:
-                            user_tables[str(role[1])][str(utk)] = True
-        # Only for admin
-        canExport = False
-        canLastId = False
-
-        if user.groups.filter(id=group_adm).exists():
-            canExport = True
-            canLastId = True
-            for tclk, tclv in self.tables_config_lite:
-                user_tables[str(tclk)] = {
-                    'view_table': True,
-                    'add_table': True,
-                    'edit_table': True,
-                    'delete_table': True
-                    }
-        # *TBC*#
-        # Not sure if the last ID is used anymore now that the system automatically provides an ID to the patient
-        if user.groups.filter(id=group_idc).exists():
-            canLastId = True
-
-        self.easy_user = {
-            'canExport': canExport,
-            'canLastId': canLastId,
-            'tables': user_tables
-            }
-        c.close()
+        group_ids = list(user.groups.values_list('id', flat=True))
+        self.easy_user = permissions.easy_user(self.db, group_ids, self.tables_config_lite)
         return self.easy_user
 
     # Check if the user has the permission to execture a function or access a page
     def backEndUserRolesCheck(self, table_id, type):
-        for k, v in self.easy_user['tables'].iteritems():
-            if k == table_id and v[type]:
-                return True
-        return False
+        return permissions.check(self.easy_user, table_id, type)
 
     # Connector to the custom functions
+    # Nothing is created if no plugin applies to the form
     def launchExternalFields(self, results):
-        extF = ExternalFields()
-        return extF.addFields(results, self.tables_config)
-
-    # Same
-    def launchSingleExternalFields(self, results):
-        extF = ExternalFields()
-        return extF.addSingleFields(results, self.tables_config)
+        plugins = registry.plugins('list', results[1], results[2])
+        if not plugins:
+            return results
+        return self.externalFields().run(plugins, results, self.tables_config)
+
+    # Same, for the details of a record
+    # values: the data of the plugins folded into the query of the record
+    def launchSingleExternalFields(self, results, values=None):
+        plugins = registry.plugins('single', results[0], [field[3] for field in results[3]])
+        if not plugins:
+            return results
+        return self.externalFields().run(plugins, results, self.tables_config, values)
+
+    def externalFields(self):
+        if self.external_fields is None:
+            self.external_fields = ExternalFields()
+        return self.external_fields
 
     # Same
     def launchExternalExport(self):
         extE = ExternalExport()
         return extE.addCSVs()
 
-    # Clean the data before saving them (or in bulk, or only one)
-    # *TBC*#
-    # Should be the same type of cleaning, so weird to have 2 functions similar
+    # Clean the data before exporting them
+    # The values saved are parameters of the statements, so they are not cleaned anymore
     def dataclean(self, row):
-        returnedRow = []
-        for field in row:
-            if field:
-                field1 = str(field).replace(',', ' ')
-                field2 = field1.replace('"', '')
-                field3 = field2.replace("'", "")
-            else:
-                field3 = ""
-            returnedRow.append(field3)
-        return returnedRow
-
-    # Same
-    def datacleansingle(self, field):
-        if field:
-            return re.sub(r'[^a-zA-Z0-9-+_<>.\s]', '', field)
-        else:
-            return ""
+        return dataclean(row)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Columns computed from the records of a form, added to the search and patient results
+# The columns of each form are configured in EASYNUT_DERIVED_COLUMNS:
+#   {table_id: [{'type': ..., 'column': ..., 'name': ...}, ...]}
+# Types:
+#   - 'difference': value of the column minus the one of the previous (older) record
+#   - 'gain': same difference, per kg of the previous value and per day between the two records
+#     (grams if the column is in kg), needs 'date': name of the column with the date of the record
+# The new column is added just after 'column'. The records are ordered from the newest to the oldest.
+
+from __future__ import unicode_literals
+import datetime
+
+from django.conf import settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+default_columns = {
+    '7': [
+        {'type': 'difference', 'column': 'Weight (kg)', 'name': 'Weight difference'},
+    ],
+}
+
+
+# Values of a column as floats, None when empty
+def floats(values):
+    result = []
+    for value in values:
+        try:
+            result.append(float(value) if value else None)
+        except (TypeError, ValueError):
+            result.append(None)
+    return result
+
+
+# Difference between each value and the next one, '' if one of them is empty
+def difference(values):
+    if numpy is not None and len(values) > 1:
+        current = numpy.array([numpy.nan if v is None else v for v in values[:-1]], dtype=float)
+        previous = numpy.array([numpy.nan if v is None else v for v in values[1:]], dtype=float)
+        deltas = current - previous
+        return ['' if numpy.isnan(d) else d for d in deltas.tolist()] + ['']
+    return [v - p if v is not None and p is not None else '' for v, p in zip(values, values[1:])] + ['']
+
+
+def days(dates):
+    result = []
+    for value in dates:
+        try:
+            result.append(datetime.datetime.strptime(str(value), '%Y-%m-%d').date())
+        except ValueError:
+            result.append(None)
+    return result
+
+
+# Gain per kg and per day between each value and the next one
+def gain(values, dates):
+    deltas = difference(values)
+    result = []
+    for delta, previous, date, previous_date in zip(deltas, values[1:], dates, dates[1:]):
+        if delta == '' or not previous or date is None or previous_date is None or date <= previous_date:
+            result.append('')
+        else:
+            result.append(round(delta * 1000 / previous / (date - previous_date).days, 1))
+    return result + ['']
+
+
+class DerivedColumns(object):
+
+    @staticmethod
+    def config():
+        return getattr(settings, 'EASYNUT_DERIVED_COLUMNS', default_columns)
+
+    def columns(self, table_id):
+        return self.config().get(table_id, [])
+
+    # Ids of the forms with derived columns
+    def tables(self):
+        return [table_id for table_id, columns in self.config().items() if columns]
+
+    def applies(self, table_id):
+        return bool(self.columns(table_id))
+
+    # Add the derived columns of the form to the results: [name, table_id, column names, rows]
+    # The rows start with the _id of the record, before the columns
+    def add(self, results):
+        for spec in self.columns(results[1]):
+            if spec['column'] not in results[2]:
+                continue
+            position = results[2].index(spec['column'])
+            rows = [list(row) for row in results[3]]
+            # Work on whole columns instead of row by row
+            values = floats([row[position + 1] for row in rows])
+            if spec['type'] == 'gain':
+                if spec['date'] not in results[2]:
+                    continue
+                dates = days([row[results[2].index(spec['date']) + 1] for row in rows])
+                derived = gain(values, dates)
+            else:
+                derived = difference(values)
+            results[2] = results[2][:position + 1] + [spec['name']] + results[2][position + 1:]
+            results[3] = [row[:position + 2] + [value] + row[position + 2:] for row, value in zip(rows, derived)]
+        return results
+
+
+derived_columns = DerivedColumns()
@@ -58,6 +58,24 @@ class FieldConfig(object):
         'relacionado': 'relationship',
     }
 
+    # Convert an attribute read from the DB for the field object
+    # *TBC*#
+    # This stupid conversion is due to a change of DB model
+    # Needs to be cleaned
+    @classmethod
+    def convert_attribute(cls, attribute, sqlresult):
+        if sqlresult in cls.hasmapft.keys():
+            return cls.hasmapft[sqlresult]
+        elif sqlresult in cls.field_types.keys():
+            return cls.field_types[sqlresult]
+        elif attribute == 'select':
+            selectlist = []
+            if sqlresult is not None:
+                for tostrip in sqlresult.split(','):
+                    selectlist.append(tostrip.strip())
+            return selectlist
+        return sqlresult
+
     # *TBC*#
     # Few attributes are not used
     def __init__(self):
@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+# Raw export of the forms: one csv per form, in a zip file
+# The rows are read with a server-side cursor and written as they come,
+# so the memory used does not depend on the size of the tables.
+# The incremental export only contains the rows added or edited since the previous one,
+# and the records deleted since, see IncrementalExport.
+
+from __future__ import unicode_literals
+from datetime import date
+import csv
+import json
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+
+from django.conf import settings
+
+from MySQLdb.cursors import SSCursor
+
+from .ColumnarExport import ColumnarExporter
+from .ConnectionPool import pool
+
+
+# Clean the data before exporting them
+def dataclean(row):
+    returnedRow = []
+    for field in row:
+        if field:
+            field1 = str(field).replace(',', ' ')
+            field2 = field1.replace('"', '')
+            field3 = field2.replace("'", "")
+        else:
+            field3 = ""
+        returnedRow.append(field3)
+    return returnedRow
+
+
+# File-like object keeping what the csv writer writes until it is taken
+class LineBuffer(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def take(self):
+        data = b''.join(self.lines)
+        self.lines = []
+        return data
+
+
+# Zip file written as a stream: the sizes and CRC of each file are written after its data
+# *TBC*#
+# No ZIP64, so each file and the whole archive must stay under 4 GB
+class ZipStream(object):
+
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+
+    def output(self, data):
+        self.offset += len(data)
+        return data
+
+    # Yield the bytes of a compressed file made of the chunks
+    def file(self, name, chunks):
+        name = name.encode('utf-8')
+        now = time.localtime()
+        dostime = now[3] << 11 | now[4] << 5 | now[5] // 2
+        dosdate = (now[0] - 1980) << 9 | now[1] << 5 | now[2]
+        flags = 0x08 | 0x800  # sizes in data descriptor, utf-8 name
+        header_offset = self.offset
+        yield self.output(struct.pack('<4s2B4HL2L2H', b'PK\x03\x04', 20, 0, flags, 8,
+                                      dostime, dosdate, 0, 0, 0, len(name), 0) + name)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        crc = 0
+        size = 0
+        compressed_size = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                compressed_size += len(data)
+                yield self.output(data)
+        data = compressor.flush()
+        compressed_size += len(data)
+        crc &= 0xffffffff
+        yield self.output(data + struct.pack('<4s3L', b'PK\x07\x08', crc, compressed_size, size))
+        self.entries.append((name, flags, dostime, dosdate, crc, compressed_size, size, header_offset))
+
+    # Yield the central directory, to call after the last file
+    def close(self):
+        start = self.offset
+        directory = b''
+        for name, flags, dostime, dosdate, crc, compressed_size, size, header_offset in self.entries:
+            directory += struct.pack('<4s4B4HL2L5H2L', b'PK\x01\x02', 20, 3, 20, 0, flags, 8,
+                                     dostime, dosdate, crc, compressed_size, size, len(name), 0, 0, 0, 0,
+                                     0o644 << 16, header_offset) + name
+        directory += struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, len(self.entries), len(self.entries),
+                                 len(directory), start, 0)
+        yield self.output(directory)
+
+
+class Exporter(object):
+
+    def __init__(self, tables_config):
+        self.tables_config = tables_config
+
+    @staticmethod
+    def filename():
+        return 'EasyNutExport' + date.today().strftime('%d%b%Y')
+
+    @staticmethod
+    def csvname(tablec):
+        return re.sub('[^\w\-_\. ]', '', tablec['name']) + '.csv'
+
+    # Columns of the export of a form and the query to get them
+    # with_id adds the DB ID of the records as first column
+    # *TBC*#
+    # The last field of the form is replaced by the user and the timestamp
+    @staticmethod
+    def query(tablec, with_id=False):
+        fields = tablec['fields'][:-1]
+        columns = [str(field['name']) for field in fields] + ['User', 'Timestamp']
+        selected = [field['field_id'] for field in fields] + ['user', 'timestamp']
+        if with_id:
+            columns = ['Record ID'] + columns
+            selected = ['_id'] + selected
+        sqlquery = 'SELECT {} FROM {}'.format(', '.join(selected), tablec['sql_table_config_name'])
+        return columns, sqlquery
+
+    # Yield the rows of a form from a server-side cursor
+    def rows(self, db, tablec, sqlquery=None, params=None):
+        if sqlquery is None:
+            sqlquery = self.query(tablec)[1]
+        c = db.cursor(SSCursor)
+        try:
+            c.execute(sqlquery, params)
+            for row in c:
+                yield row
+        finally:
+            c.close()
+
+    # Yield the csv of a form, a few rows at a time
+    # progress, if given, is called with the number of rows written so far
+    # query, if given, replaces the one of the form: (columns, sqlquery, params)
+    def csv_chunks(self, db, tablec, rows_per_chunk=500, progress=None, query=None):
+        columns, sqlquery, params = query or self.query(tablec) + (None,)
+        buf = LineBuffer()
+        wr = csv.writer(buf, quoting=csv.QUOTE_ALL)
+        wr.writerow(dataclean(columns))
+        counter = 0
+        for counter, row in enumerate(self.rows(db, tablec, sqlquery, params), 1):
+            wr.writerow(dataclean(row))
+            if counter % rows_per_chunk == 0:
+                if progress is not None:
+                    progress(counter)
+                yield buf.take()
+        if progress is not None:
+            progress(counter)
+        yield buf.take()
+
+    def write_csv(self, db, tablec, path, progress=None):
+        with open(path, 'wb') as mycsv:
+            for chunk in self.csv_chunks(db, tablec, progress=progress):
+                mycsv.write(chunk)
+
+    # Yield the zip of all the forms, on its own connection as it is consumed after the view returns
+    def stream_zip(self):
+        db = pool.checkout()
+        try:
+            archive = ZipStream()
+            for tablec in self.tables_config:
+                for data in archive.file(self.csvname(tablec), self.csv_chunks(db, tablec)):
+                    yield data
+            for data in archive.close():
+                yield data
+        finally:
+            pool.checkin(db)
+
+
+# Export run in the background: the forms are dumped in parallel, each by a thread with its own connection,
+# then zipped. The progress is kept in a json file in the directory of the job,
+# so that any worker of the app can report it.
+# The forms are dumped as csv, or in one of the columnar formats, see ColumnarExport.
+# The job saves its progress at least every heartbeat seconds. A running job which has not saved it
+# for EASYNUT_EXPORT_STALE_AFTER seconds died with its worker (restarted or killed), it is reported as failed.
+class ExportJob(object):
+
+    heartbeat = 10
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.lock = threading.Lock()
+        self.progress = None
+
+    @staticmethod
+    def jobs_dir():
+        return os.path.join(settings.BASE_DIR, 'export', 'jobs')
+
+    @staticmethod
+    def valid_id(job_id):
+        return bool(re.match('^[0-9a-f]{32}$', job_id or ''))
+
+    def path(self, *names):
+        return os.path.join(self.jobs_dir(), self.id, *names)
+
+    # Start a new export of the forms and return its job
+    @classmethod
+    def start(cls, tables_config, fmt='csv'):
+        cls.cleanup()
+        job = cls(uuid.uuid4().hex)
+        os.makedirs(job.path('CSVFiles'))
+        exporter = Exporter(tables_config)
+        job.progress = {
+            'id': job.id,
+            'format': fmt,
+            'status': 'running',
+            'started': time.time(),
+            'elapsed': 0,
+            'saved': time.time(),
+            'archive': exporter.filename() + '.zip',
+            'tables': dict((tablec['name'], {'rows': 0, 'bytes': 0, 'elapsed': 0, 'status': 'waiting'})
+                           for tablec in tables_config),
+        }
+        job.update()
+        thread = threading.Thread(target=job.run, args=(exporter,))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    # Remove the jobs older than a day
+    @classmethod
+    def cleanup(cls):
+        if not os.path.isdir(cls.jobs_dir()):
+            return
+        for job_id in os.listdir(cls.jobs_dir()):
+            path = os.path.join(cls.jobs_dir(), job_id)
+            if os.path.getmtime(path) < time.time() - 86400:
+                shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def stale_after():
+        return getattr(settings, 'EASYNUT_EXPORT_STALE_AFTER', 60)
+
+    # Progress of a job, None if it does not exist
+    @classmethod
+    def status(cls, job_id):
+        if not cls.valid_id(job_id):
+            return None
+        try:
+            with open(cls(job_id).path('progress.json')) as fh:
+                progress = json.load(fh)
+        except IOError:
+            return None
+        if progress['status'] == 'running' and time.time() - progress.get('saved', 0) > cls.stale_after():
+            progress['status'] = 'failed'
+            progress['error'] = 'The export stopped without finishing, the server was probably restarted'
+        return progress
+
+    # Path of the zip of a finished job, None if it is not ready
+    @classmethod
+    def archive(cls, job_id):
+        progress = cls.status(job_id)
+        if progress is None or progress['status'] != 'done':
+            return None
+        return cls(job_id).path(progress['archive'])
+
+    # Update the progress of the job, or of one of its forms, and save it
+    def update(self, table_name=None, **values):
+        with self.lock:
+            if table_name is None:
+                self.progress.update(values)
+            else:
+                self.progress['tables'][table_name].update(values)
+            self.progress['saved'] = time.time()
+            self.progress['elapsed'] = self.progress['saved'] - self.progress['started']
+            with open(self.path('progress.json.tmp'), 'w') as fh:
+                json.dump(self.progress, fh)
+            os.rename(self.path('progress.json.tmp'), self.path('progress.json'))
+
+    # Save the progress every heartbeat seconds until stopped is set
+    def beat(self, stopped):
+        while not stopped.wait(self.heartbeat):
+            self.update()
+
+    def run(self, exporter):
+        stopped = threading.Event()
+        heart = threading.Thread(target=self.beat, args=(stopped,))
+        heart.daemon = True
+        heart.start()
+        try:
+            tables = list(exporter.tables_config)
+            workers = []
+            for n in range(min(getattr(settings, 'EASYNUT_EXPORT_WORKERS', 4), len(tables))):
+                worker = threading.Thread(target=self.work, args=(exporter, tables))
+                worker.start()
+                workers.append(worker)
+            for worker in workers:
+                worker.join()
+            if any(table['status'] != 'done' for table in self.progress['tables'].values()):
+                raise Exception('Some forms could not be exported')
+            # The columnar files are already compressed
+            compression = zipfile.ZIP_DEFLATED if self.progress['format'] == 'csv' else zipfile.ZIP_STORED
+            with zipfile.ZipFile(self.path(self.progress['archive']), 'w', compression,
+                                 allowZip64=True) as archive:
+                for tablec in exporter.tables_config:
+                    archive.write(self.path('CSVFiles', self.filename(exporter, tablec)),
+                                  self.filename(exporter, tablec))
+            self.update(status='done')
+        except Exception as e:
+            self.update(status='failed', error=str(e))
+        finally:
+            stopped.set()
+
+    # Dump the forms left in the list until there is none
+    def work(self, exporter, tables):
+        db = pool.checkout()
+        try:
+            while True:
+                with self.lock:
+                    if not tables:
+                        return
+                    tablec = tables.pop(0)
+                self.dump(exporter, db, tablec)
+        finally:
+            pool.checkin(db)
+
+    # Name of the file of a form in the format of the job
+    def filename(self, exporter, tablec):
+        if self.progress['format'] == 'csv':
+            return exporter.csvname(tablec)
+        return ColumnarExporter(exporter).filename(tablec, self.progress['format'])
+
+    # Size of a file being written, 0 until it is created (the npz files are written at the end)
+    @staticmethod
+    def size(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def dump(self, exporter, db, tablec):
+        path = self.path('CSVFiles', self.filename(exporter, tablec))
+        started = time.time()
+        # Rows written and time of the last save
+        written = {'rows': 0, 'saved': started}
+
+        # Save the progress at most once per second
+        def progress(rows):
+            written['rows'] = rows
+            if time.time() - written['saved'] >= 1:
+                written['saved'] = time.time()
+                self.update(tablec['name'], rows=rows, bytes=self.size(path), elapsed=time.time() - started)
+
+        self.update(tablec['name'], status='running')
+        try:
+            if self.progress['format'] == 'csv':
+                exporter.write_csv(db, tablec, path, progress)
+            else:
+                ColumnarExporter(exporter).write(db, tablec, path, self.progress['format'], progress)
+            status = {'status': 'done'}
+        except Exception as e:
+            status = {'status': 'failed', 'error': str(e)}
+        status['rows'] = written['rows']
+        status['bytes'] = self.size(path)
+        status['elapsed'] = time.time() - started
+        self.update(tablec['name'], **status)
+
+
+# Log of the records added, edited and deleted, for the incremental export
+# Written by the DAO in the transaction of the change when EASYNUT_INCREMENTAL_EXPORT is enabled,
+# the table is created by the incrementalexport command.
+# The "timestamp" column of the forms is not used, as it is the time the record was created and is shown as such.
+class ChangeLog(object):
+
+    create_sql = ('CREATE TABLE IF NOT EXISTS easy_changes ('
+                  'id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+                  'table_id VARCHAR(32) NOT NULL, '
+                  'record_id INT NOT NULL, '
+                  'kind VARCHAR(8) NOT NULL, '
+                  'changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+                  'KEY changes (table_id, id))')
+
+    @staticmethod
+    def enabled():
+        return getattr(settings, 'EASYNUT_INCREMENTAL_EXPORT', False)
+
+    def create(self, db):
+        c = db.cursor()
+        c.execute(self.create_sql)
+        c.close()
+
+    # To call in the transaction changing the record
+    # kind: 'insert', 'edit' or 'delete'
+    def record(self, db, table_id, record_id, kind):
+        if self.enabled():
+            c = db.cursor()
+            c.execute('INSERT INTO easy_changes (table_id, record_id, kind) VALUES (%s, %s, %s)',
+                      [table_id, record_id, kind])
+            c.close()
+
+    # To call in the transaction adding records in bulk: all the records of the form after since_id are logged
+    # The records added at the same time by other requests are logged twice, which does no harm
+    def record_new(self, db, tablec, since_id):
+        if self.enabled():
+            c = db.cursor()
+            c.execute("INSERT INTO easy_changes (table_id, record_id, kind) "
+                      "SELECT %s, _id, 'insert' FROM {} WHERE _id > %s".format(tablec['sql_table_config_name']),
+                      [tablec['id'], since_id])
+            c.close()
+
+
+change_log = ChangeLog()
+
+
+# Export of the rows added or edited, and of the records deleted, since the previous incremental export
+# The watermark is the id of the last change in the change log: each export takes the records changed
+# after the watermark of the previous one, up to the last change when it starts, then saves it in the manifest.
+# Without manifest (first export, or a new form), all the rows are exported.
+# The manifest is only saved once the zip is written, so a failed export is done again the next time.
+# *TBC*#
+# A change made in a transaction still open when the export starts can be missed, if it got a lower id
+# than the last change. The DAO commits right after each change, so this is only a matter of milliseconds.
+class IncrementalExport(object):
+
+    def __init__(self, tables_config):
+        self.tables_config = tables_config
+        self.exporter = Exporter(tables_config)
+
+    @staticmethod
+    def export_dir():
+        return os.path.join(settings.BASE_DIR, 'export', 'incremental')
+
+    def path(self, name):
+        return os.path.join(self.export_dir(), name)
+
+    # Manifest of the last successful export, None if there is none
+    def manifest(self):
+        try:
+            with open(self.path('manifest.json')) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return None
+
+    # Columns, query and parameters of the rows of a form changed between the two watermarks, all if since is None
+    def query(self, tablec, since, until):
+        columns, sqlquery = self.exporter.query(tablec, with_id=True)
+        params = []
+        if since is not None:
+            sqlquery += (" WHERE _id IN (SELECT record_id FROM easy_changes "
+                         "WHERE table_id = %s AND kind <> 'delete' AND id > %s AND id <= %s)")
+            params = [tablec['id'], since, until]
+        return columns, sqlquery, params
+
+    # Yield the csv of the records deleted between the two watermarks
+    def deleted_chunks(self, db, since, until, progress):
+        sqlquery = ("SELECT table_id, record_id, changed_at FROM easy_changes "
+                    "WHERE kind = 'delete' AND id > %s AND id <= %s ORDER BY id")
+        query = (['Form ID', 'Record ID', 'Deleted at'], sqlquery, [since, until])
+        return self.exporter.csv_chunks(db, None, progress=progress, query=query)
+
+    # Write the zip of the changes since the previous export and return its path
+    def run(self, db):
+        if not os.path.isdir(self.export_dir()):
+            os.makedirs(self.export_dir())
+        change_log.create(db)
+        previous = self.manifest() or {}
+        if 'changes' not in previous:
+            previous = {'tables': {}, 'changes': {'last': 0}}
+        c = db.cursor()
+        c.execute('SELECT NOW(), COALESCE(MAX(id), 0) FROM easy_changes')
+        now, until = c.fetchone()
+        c.close()
+        manifest = {
+            'generated': time.time(),
+            'archive': 'EasyNutDelta' + re.sub('[^0-9]', '', str(now)) + '.zip',
+            'tables': {},
+            'changes': {'since': previous['changes']['last'], 'last': until, 'deleted': 0},
+        }
+        tmp = self.path(manifest['archive'] + '.tmp')
+        try:
+            archive = ZipStream()
+            with open(tmp, 'wb') as fh:
+                for tablec in self.tables_config:
+                    since = previous['tables'].get(tablec['id'], {}).get('watermark')
+                    table = {'name': tablec['name'], 'since': since, 'watermark': until, 'rows': 0}
+                    manifest['tables'][tablec['id']] = table
+
+                    def progress(rows, table=table):
+                        table['rows'] = rows
+                    chunks = self.exporter.csv_chunks(db, tablec, progress=progress,
+                                                      query=self.query(tablec, since, until))
+                    for data in archive.file(self.exporter.csvname(tablec), chunks):
+                        fh.write(data)
+
+                def progress(rows):
+                    manifest['changes']['deleted'] = rows
+                chunks = self.deleted_chunks(db, previous['changes']['last'], until, progress)
+                for data in archive.file('Deleted records.csv', chunks):
+                    fh.write(data)
+                for data in archive.file('manifest.json', [json.dumps(manifest, indent=2).encode('utf-8')]):
+                    fh.write(data)
+                for data in archive.close():
+                    fh.write(data)
+            os.rename(tmp, self.path(manifest['archive']))
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        with open(self.path('manifest.json.tmp'), 'w') as fh:
+            json.dump(manifest, fh, indent=2)
+        os.rename(self.path('manifest.json.tmp'), self.path('manifest.json'))
+        return self.path(manifest['archive'])
@@ -14,114 +14,137 @@ import os
 
 from django.conf import settings
 
-from MySQLdb import converters
-import MySQLdb
+from .ConnectionPool import pool
+from .PatientSummary import patient_summary
+from .QueryBuilder import queries, identifier
 
 
 class ExternalExport(object):
 
     def __init__(self):
-        conv = converters.conversions.copy()
-        conv[246] = float    # convert decimals to floats
-        conv[10] = str       # convert dates
-        self.db = MySQLdb.connect(settings.DATABASES['data']['HOST'],
-                                  settings.DATABASES['data']['USER'],
-                                  settings.DATABASES['data']['PASSWORD'],
-                                  settings.DATABASES['data']['NAME'], conv=conv)
+        self.db = pool.connection()
 
-    def getAbsents(self):
+    # Patients expected 7 to 14 days ago who did not come back
+    # The facts needed for each patient are fetched in bulk, then joined in memory
+    # The report is written at path, export/Absents.csv by default
+    def getAbsents(self, path=None):
         c = self.db.cursor()
         listOfAbsents = []
         sql_select = ("SELECT bd.campo_1,bd.campo_2,bd.campo_14,c.campo_30 "
                       "FROM tabla_1 bd LEFT JOIN tabla_8 c ON (bd.campo_1 = c.campo_2) "
                       "WHERE bd.campo_14 IS NOT NULL AND bd.campo_14 <> 'NULL' "
                       "AND c.campo_30 IS NOT NULL AND c.campo_30 <> 'NULL' "
+                      # Rough window, checked precisely below
+                      "AND c.campo_30 BETWEEN DATE_SUB(CURDATE(), INTERVAL 14 DAY) "
+                      "AND DATE_SUB(CURDATE(), INTERVAL 7 DAY) "
                       "ORDER BY c.campo_1 ")
         c.execute(sql_select)
         listOfAbsents = c.fetchall()
-        reducedLists = {}
-        today = datetime.datetime.now()
-        for absent in listOfAbsents:
-            visitdate = datetime.datetime.strptime(absent[3], '%Y-%m-%d')
-            vistDate7 = visitdate + datetime.timedelta(days=7)
-            visitDate14 = visitdate + datetime.timedelta(days=14)
-            if (today >= vistDate7) and (today <= visitDate14):
-                sql_query = ('SELECT campo_1 FROM tabla_8 '
-                             'WHERE campo_2 = "' + absent[0] + '" AND campo_1 IS NOT NULL AND campo_1 <> "NULL" '
-                             'ORDER BY campo_1 DESC LIMIT 1')
-                c.execute(sql_query)
-                lastVisitStringL = c.fetchone()
-                if lastVisitStringL:
-                    lastVisitString = lastVisitStringL[0]
-                    if lastVisitString and lastVisitString != '':
-                        lastVisit = datetime.datetime.strptime(lastVisitString, '%Y-%m-%d')
-                        if lastVisit < visitdate:
-                            canContinueIM = True
-                            canContinueDis = True
-                            canContinueAbs = True
-                            canContinue = True
-                            # Checking Internal movements to ITFC
-                            sql_im = ('SELECT campo_1 FROM tabla_5 WHERE campo_2 = "' + absent[0] + '" '
-                                      'AND campo_3 = "Transfer out" '
-                                      'AND campo_1 IS NOT NULL AND campo_1 <> "NULL" '
-                                      'ORDER BY campo_1 DESC LIMIT 1')
-                            c.execute(sql_im)
-                            lastIML = c.fetchone()
-                            if not lastIML:
-                                canContinueIM = False
-                            if canContinueIM:
-                                lastIM = lastIML[0]
-                            if canContinueIM and lastIM and lastIM != 'NULL':
-                                lastIMDate = datetime.datetime.strptime(lastIM, '%Y-%m-%d')
-                                if lastIMDate > visitdate:
-                                    canContinue = False
-                            # Checking Discharges
-                            if canContinue:
-                                sql_dis = ('SELECT COUNT(*) FROM tabla_4 WHERE campo_2 = "' + absent[0] + '" ')
-                                c.execute(sql_dis)
-                                countDis = c.fetchone()
-                                if not countDis:
-                                    canContinueDis = False
-                                if canContinueDis:
-                                    lastDis = int(countDis[0])
-                                    if lastDis > 0:
-                                        canContinue = False
-                            # Checking absent called made
-                            if canContinue:
-                                sql_abs = ('SELECT campo_1 FROM tabla_17 WHERE campo_2 = "' + absent[0] + '" '
-                                          'AND campo_1 IS NOT NULL AND campo_1 <> "NULL" '
-                                          'ORDER BY campo_1 DESC LIMIT 1')
-                                c.execute(sql_abs)
-                                lastAbsL = c.fetchone()
-                                if not lastAbsL:
-                                    canContinueAbs = False
-                                if canContinueAbs:
-                                    lastAbs = lastAbsL[0]
-                                if canContinueAbs and lastAbs and lastAbs != 'NULL':
-                                    lastAbsDate = datetime.datetime.strptime(lastAbs, '%Y-%m-%d')
-                                    if lastAbsDate > visitdate:
-                                        canContinue = False
-
-                            if canContinue:
-                                if absent[0] not in reducedLists:
-                                    reducedLists[absent[0]] = [absent[1], absent[2], absent[3]]
-                                else:
-                                    compaDate = datetime.datetime.strptime(reducedLists[absent[0]][2], '%Y-%m-%d')
-                                    newDate = datetime.datetime.strptime(absent[3], '%Y-%m-%d')
-                                    if newDate > compaDate:
-                                        reducedLists[absent[0]] = [absent[1], absent[2], absent[3]]
-        exportDir = os.path.join(settings.BASE_DIR, 'export/')
-        with open(exportDir+'Absents'+'.csv', 'wb') as mycsv:
+        if patient_summary.enabled():
+            c.execute('SELECT msf_id, last_visit, last_transfer_out, discharges, last_absent_call '
+                      'FROM easy_patient_summary')
+            summaries = c.fetchall()
+            lastVisits = dict((row[0], row[1]) for row in summaries if row[1])
+            lastTransfers = dict((row[0], row[2]) for row in summaries if row[2])
+            discharged = set(row[0] for row in summaries if row[3])
+            lastCalls = dict((row[0], row[4]) for row in summaries if row[4])
+        else:
+            # Last visit
+            lastVisits = self.latestDates(c, 'tabla_8')
+            # Internal movements to ITFC
+            lastTransfers = self.latestDates(c, 'tabla_5', [('campo_3', 'Transfer out')])
+            # Discharges
+            c.execute('SELECT DISTINCT campo_2 FROM tabla_4')
+            discharged = set(row[0] for row in c.fetchall())
+            # Absent calls made
+            lastCalls = self.latestDates(c, 'tabla_17')
+        reducedLists = self.computeAbsents(listOfAbsents, lastVisits, lastTransfers, discharged, lastCalls,
+                                           datetime.datetime.now())
+        if path is None:
+            path = os.path.join(settings.BASE_DIR, 'export/') + 'Absents.csv'
+        with open(path, 'wb') as mycsv:
             wr = csv.writer(mycsv, quoting=csv.QUOTE_ALL)
             wr.writerow(['MSF ID', 'Name', 'Phone number', 'Last expected visit'])
             for k, v in reducedLists.iteritems():
                 wr.writerow(self.dataclean([k, v[0], v[1], v[2]]))
         c.close()
-        return exportDir + 'Absents.csv'
+        return path
+
+    # Latest date (campo_1) of a form for each patient
+    # conditions: list of (column, value) the records must match
+    @staticmethod
+    def latestDates(c, table, conditions=()):
+        columns = tuple(column for column, value in conditions)
+        sql_query = queries.statement(('latestDates', table, columns), lambda: (
+            "SELECT campo_2, MAX(campo_1) FROM {} "
+            "WHERE campo_1 IS NOT NULL AND campo_1 <> 'NULL' {}"
+            "GROUP BY campo_2").format(identifier(table),
+                                       ''.join('AND {} = %s '.format(identifier(column)) for column in columns)))
+        c.execute(sql_query, [value for column, value in conditions])
+        return dict(c.fetchall())
 
-    def getDefaulters(self):
+    # Keep, for each patient, the last expected visit in the 7 to 14 days window
+    # if nothing happened since: no visit, no transfer to ITFC, no discharge, no absent call
+    @staticmethod
+    def computeAbsents(listOfAbsents, lastVisits, lastTransfers, discharged, lastCalls, today):
+        dates = {}
+
+        def parse(value):
+            if value not in dates:
+                dates[value] = datetime.datetime.strptime(value, '%Y-%m-%d')
+            return dates[value]
+
+        reducedLists = {}
+        for absent in listOfAbsents:
+            visitdate = parse(absent[3])
+            if not (visitdate + datetime.timedelta(days=7) <= today <= visitdate + datetime.timedelta(days=14)):
+                continue
+            lastVisit = lastVisits.get(absent[0])
+            if not lastVisit or parse(lastVisit) >= visitdate:
+                continue
+            lastIM = lastTransfers.get(absent[0])
+            if lastIM and parse(lastIM) > visitdate:
+                continue
+            if absent[0] in discharged:
+                continue
+            lastAbs = lastCalls.get(absent[0])
+            if lastAbs and parse(lastAbs) > visitdate:
+                continue
+            if absent[0] not in reducedLists or visitdate > parse(reducedLists[absent[0]][2]):
+                reducedLists[absent[0]] = [absent[1], absent[2], absent[3]]
+        return reducedLists
+
+    # The report is written at path, export/Defaulters.csv by default
+    def getDefaulters(self, path=None):
         c = self.db.cursor()
-        sql_select = (
+        sql_select = self.defaulters_summary_query if patient_summary.enabled() else self.defaulters_query
+        c.execute(sql_select)
+        listOfAbsents = c.fetchall()
+        if path is None:
+            path = os.path.join(settings.BASE_DIR, 'export/') + 'Defaulters.csv'
+        with open(path, 'wb') as mycsv:
+            wr = csv.writer(mycsv, quoting=csv.QUOTE_ALL)
+            wr.writerow(['MSF ID', 'Name', 'Last expected visit'])
+            for k in listOfAbsents:
+                wr.writerow(self.dataclean([k[0], k[1], k[2]]))
+        c.close()
+        return path
+
+    # Same conditions as the query below, from the summary of the patients
+    defaulters_summary_query = (
+        "SELECT bd.campo_1, bd.campo_2, s.next_appointment "
+        "FROM tabla_1 bd "
+        "INNER JOIN easy_patient_summary s ON (s.msf_id = bd.campo_1) "
+        "WHERE CURDATE() >= DATE_ADD(s.next_appointment, INTERVAL 14 DAY) "
+        "AND s.discharges = 0 "
+        "AND (s.next_appointment_visit IS NULL OR ("
+            "(s.last_visit IS NULL OR s.last_visit <= s.next_appointment_visit) "
+            "AND (s.last_im_out IS NULL OR s.last_im_out <= s.next_appointment_visit) "
+            "AND (s.last_absent_call IS NULL OR s.last_absent_call <= s.next_appointment_visit))) "
+        "ORDER BY s.next_appointment"
+    )
+
+    defaulters_query = (
             # Select the ID, the name, and the expected visit date
             "SELECT bd.campo_1,bd.campo_2, c.campo_30 "
             # From the bio data
@@ -158,17 +181,7 @@ class ExternalExport(object):
                 "FROM easynutdata.tabla_17 ac "
                 "WHERE ac.campo_2 = bd.campo_1 AND ac.campo_1 > c.campo_1) "
             "ORDER BY c.campo_30"
-                      )
-        c.execute(sql_select)
-        listOfAbsents = c.fetchall()
-        exportDir = os.path.join(settings.BASE_DIR, 'export/')
-        with open(exportDir+'Defaulters'+'.csv', 'wb') as mycsv:
-            wr = csv.writer(mycsv, quoting=csv.QUOTE_ALL)
-            wr.writerow(['MSF ID', 'Name', 'Last expected visit'])
-            for k in listOfAbsents:
-                wr.writerow(self.dataclean([k[0], k[1], k[2]]))
-        c.close()
-        return exportDir + 'Defaulters.csv'
+    )
 
     def dataclean(self, row):
         returnedRow = []
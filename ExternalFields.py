@@ -1,116 +1,191 @@
 # -*- coding: utf-8 -*-
+# Custom calculations added to the results of the forms ("external fields")
+# Each calculation is a plugin of the registry, declaring up front:
+#   - mode: 'list' for the results of a search or the records of a patient, 'single' for the details of a record
+#   - the forms it applies to and the listed columns it needs, it is skipped if one is missing
+#   - for 'single' plugins, the SQL expressions it needs, folded into the query of the record
+# So the DAO only runs the plugins that apply, and does not need any connection when none does.
 # *TBC*#
-# Allow to add some customization
-# But this should not be hardcoded
-# A better system to add cusomization features should be found
+# The plugins are still written in Python and know the forms and fields they use.
 # An idea could be to to enter SQL queries in the DB via a user interface for the admin
-# But not sure how to avoid knowing perfectly the DB (having to know the table name and field name),
-# or if we could obtain such a precision
 
 from __future__ import unicode_literals
+from collections import defaultdict
 import datetime
+import time
 
-from django.conf import settings
+from .ConnectionPool import pool
+from .DerivedColumns import derived_columns
+from .PatientSummary import patient_summary
 
-from MySQLdb import converters
-import MySQLdb
 
+class ExternalField(object):
 
-class ExternalFields(object):
+    # Name of the plugin, used in the timings
+    name = ''
+    mode = 'list'
+    # Names of the listed columns it needs
+    columns = ()
 
-    def __init__(self):
-        conv = converters.conversions.copy()
-        conv[246] = float    # convert decimals to floats
-        conv[10] = str       # convert dates
-        self.db = MySQLdb.connect(settings.DATABASES['data']['HOST'],
-                                  settings.DATABASES['data']['USER'],
-                                  settings.DATABASES['data']['PASSWORD'],
-                                  settings.DATABASES['data']['NAME'], conv=conv)
-
-    def addFields(self, results, tables_config):
-        if results[1] == '7':
-            results = self.addWeightDifference(results, tables_config)
-        return results
+    # Ids of the forms it applies to
+    def tables(self):
+        return ()
 
-    def addSingleFields(self, results, tables_config):
-        if results[0] == '1':
-            results = self.addLastStepSingle(results, tables_config)
-            results = self.addNextAppointmentSingle(results, tables_config)
+    # SQL expressions to add to the query of the record, as a list of (alias, expression)
+    # {msf_id} is replaced by the column with the MSF ID of the record
+    def select(self, tables_config):
+        return []
+
+    # Add the calculation to the results
+    # values: dictionary of the folded expressions, by alias
+    def apply(self, extF, results, tables_config, values):
         return results
 
-    def addLastStepSingle(self, results, tables_config):
-        c = self.db.cursor()
-        lastStep = []
-        msfId = ''
-        for field in results[3]:
-            if field[3] == 'MSF ID':
-                msfId = field[4]
-        listLength = len(results[3])
-        if msfId:
+
+# Columns computed from the other columns of a form, see DerivedColumns
+class DerivedColumnsField(ExternalField):
+
+    name = 'derived columns'
+    mode = 'list'
+
+    def tables(self):
+        return derived_columns.tables()
+
+    def apply(self, extF, results, tables_config, values):
+        return derived_columns.add(results)
+
+
+# MSF ID of the details of a record, '' if it has none
+def msfId(results):
+    for field in results[3]:
+        if field[3] == 'MSF ID':
+            return field[4] or ''
+    return ''
+
+
+# Line added at the end of the details of a patient
+def singleLine(results, name, answer):
+    results[3].append([0, 0, len(results[3])+1, name, answer, ''])
+    return results
+
+
+# Last form filled for the patient
+class LastStepField(ExternalField):
+
+    name = 'last step'
+    mode = 'single'
+    columns = ('MSF ID',)
+
+    def tables(self):
+        return ('1',)
+
+    def select(self, tables_config):
+        if patient_summary.enabled():
+            return [
+                ('last_step_form', '(SELECT last_step_form FROM easy_patient_summary WHERE msf_id = {msf_id})'),
+                ('last_step_at', '(SELECT last_step_at FROM easy_patient_summary WHERE msf_id = {msf_id})'),
+            ]
+        # Latest timestamp of every form
+        return [('step_' + tablec['id'],
+                 '(SELECT MAX(timestamp) FROM {} WHERE campo_2 = {{msf_id}})'.format(tablec['sql_table_config_name']))
+                for tablec in tables_config if tablec['id'] != '1']
+
+    def apply(self, extF, results, tables_config, values):
+        if not msfId(results):
+            return results
+        if patient_summary.enabled():
+            lastStep, timestamp = values.get('last_step_form'), values.get('last_step_at')
+        else:
             laststeps = {}
             for tablec in tables_config:
-                if tablec['id'] != '1':
-                    sql_query = 'SELECT MAX(timestamp) FROM {} WHERE campo_2 = {}'
-                    params = [tablec['sql_table_config_name'], msfId]
-                    c.execute(sql_query.format(*params))
-                    timestamp = c.fetchone()[0]
-                    if timestamp:
-                        laststeps[tablec['name']] = timestamp
-            if bool(laststeps):
-                lastStep = max(laststeps, key=laststeps.get)
-                Date = laststeps[lastStep].strftime('%a %d %b at %H:%M')
-                Answer = lastStep + ' - ' + Date
-                lastStep = [0, 0, listLength+1, 'Last step', Answer, '']
-            else:
-                lastStep = [0, 0, listLength+1, 'Last step', 'New', '']
-            results[3].append(lastStep)
-        return results
+                if values.get('step_' + tablec['id']):
+                    laststeps[tablec['name']] = values['step_' + tablec['id']]
+            lastStep = max(laststeps, key=laststeps.get) if laststeps else None
+            timestamp = laststeps.get(lastStep)
+        if lastStep:
+            return singleLine(results, 'Last step', lastStep + ' - ' + timestamp.strftime('%a %d %b at %H:%M'))
+        return singleLine(results, 'Last step', 'New')
 
-    def addNextAppointmentSingle(self, results, tables_config):
-        c = self.db.cursor()
-        lastStep = []
-        msfId = ''
-        for field in results[3]:
-            if field[3] == 'MSF ID':
-                msfId = field[4]
-        listLength = len(results[3])
-        if msfId:
-            sql_query = ('SELECT campo_30 FROM tabla_8 WHERE campo_7 IS NOT NULL AND campo_2 = {} '
-                         'ORDER BY timestamp DESC LIMIT 1')
-            params = [msfId]
-            c.execute(sql_query.format(*params))
-            date = c.fetchone()
-            if bool(date) and date[0] is not None:
-                datetime_object = datetime.datetime.strptime(date[0], '%Y-%m-%d')
-                lastStep = [0, 0, listLength+1, 'Next visit', datetime_object.strftime('%A %d %B %Y'), '']
-            else:
-                lastStep = [0, 0, listLength+1, 'Next visit', 'Unknown', '']
-            results[3].append(lastStep)
-        return results
 
-    def addWeightDifference(self, results, tables_config):
-        weightInd = 0
-        newColumns = []
-        for counter0, column in enumerate(results[2]):
-            if column == 'Weight (kg)':
-                weightInd = counter0
-                newColumns.append('Weight (kg)')
-                newColumns.append('Weight difference')
-            else:
-                newColumns.append(column)
-        results[2] = newColumns
-        newResults = []
-        for counter1, result in enumerate(results[3]):
-            newIndResult = []
-            for counter2, fieldr in enumerate(result):
-                newIndResult.append(fieldr)
-                if counter2 == weightInd + 1:
-                    if (counter1 != (len(results[3])-1) and
-                            results[3][counter1][weightInd+1] and
-                            results[3][counter1+1][weightInd+1]):
-                        newIndResult.append(results[3][counter1][weightInd+1] - results[3][counter1+1][weightInd+1])
-                    else:
-                        newIndResult.append('')
-            newResults.append(newIndResult)
-        results[3] = newResults
+# Appointment given in the last consultation
+class NextVisitField(ExternalField):
+
+    name = 'next visit'
+    mode = 'single'
+    columns = ('MSF ID',)
+
+    def tables(self):
+        return ('1',)
+
+    def select(self, tables_config):
+        if patient_summary.enabled():
+            return [('next_visit', '(SELECT next_visit FROM easy_patient_summary WHERE msf_id = {msf_id})')]
+        return [('next_visit', '(SELECT campo_30 FROM tabla_8 WHERE campo_7 IS NOT NULL AND campo_2 = {msf_id} '
+                               'ORDER BY timestamp DESC LIMIT 1)')]
+
+    def apply(self, extF, results, tables_config, values):
+        if not msfId(results):
+            return results
+        date = values.get('next_visit')
+        if date is not None:
+            datetime_object = datetime.datetime.strptime(str(date), '%Y-%m-%d')
+            return singleLine(results, 'Next visit', datetime_object.strftime('%A %d %B %Y'))
+        return singleLine(results, 'Next visit', 'Unknown')
+
+
+class ExternalFieldsRegistry(object):
+
+    def __init__(self):
+        self.fields = []
+        # Plugins by (mode, table id, columns), computed once
+        self.compiled = {}
+
+    def register(self, field):
+        self.fields.append(field)
+        self.compiled = {}
+        return field
+
+    # Plugins to run on the results of a form, in the order they were registered
+    def plugins(self, mode, table_id, columns):
+        key = (mode, table_id, tuple(columns))
+        if key not in self.compiled:
+            self.compiled[key] = [field for field in self.fields
+                                  if field.mode == mode and table_id in field.tables()
+                                  and all(column in columns for column in field.columns)]
+        return self.compiled[key]
+
+    # SQL expressions of the plugins, as a list of (alias, expression)
+    @staticmethod
+    def select(plugins, tables_config, msf_column):
+        return [(alias, expression.format(msf_id=msf_column))
+                for field in plugins for alias, expression in field.select(tables_config)]
+
+
+registry = ExternalFieldsRegistry()
+registry.register(DerivedColumnsField())
+registry.register(LastStepField())
+registry.register(NextVisitField())
+
+
+# Runs the plugins for the DAO, keeping how long each one took
+class ExternalFields(object):
+
+    def __init__(self):
+        self._db = None
+        # Calls and seconds spent by plugin
+        self.timings = defaultdict(lambda: [0, 0.0])
+
+    # Connection for the plugins that need to query the DB, only taken when used
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = pool.connection()
+        return self._db
+
+    def run(self, plugins, results, tables_config, values=None):
+        for field in plugins:
+            started = time.time()
+            results = field.apply(self, results, tables_config, values or {})
+            self.timings[field.name][0] += 1
+            self.timings[field.name][1] += time.time() - started
         return results
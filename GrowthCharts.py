@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Data of the charts of the patient page (weight, height, MUAC... over time)
+# A chart is defined in the schema by an int field whose select is "grafico:<field of the x axis>".
+# The definitions are computed once per configuration of the forms.
+# The series of a patient are read with one query per form and x axis.
+# If EASYNUT_GRAPH_CACHE names a Django cache shared by the workers (memcached, database, ...),
+# they are kept in it until a record of the patient in that form changes, as any worker can make the change.
+# Without it, they are not cached.
+# The patient page only shows the last EASYNUT_GRAPH_WINDOW days (all if None),
+# downsampled to EASYNUT_GRAPH_MAX_POINTS points, the other ranges are served as json.
+
+from __future__ import unicode_literals
+import hashlib
+import time
+
+from django.conf import settings
+
+from .EasyDBObjects import FieldConfig
+
+
+# Largest-triangle-three-buckets downsampling of [x, y] points sorted by x
+# Keeps the first and last points and, in each bucket, the point making the largest triangle
+# with the point kept before and the average of the next bucket
+def lttb(points, threshold):
+    if threshold < 3 or len(points) <= threshold:
+        return points
+    sampled = [points[0]]
+    every = float(len(points) - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, len(points))
+        avg_x = sum(point[0] for point in points[avg_start:avg_end]) / float(avg_end - avg_start)
+        avg_y = sum(point[1] for point in points[avg_start:avg_end]) / float(avg_end - avg_start)
+        ax, ay = points[a]
+        max_area = -1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                next_a = j
+        sampled.append(points[next_a])
+        a = next_a
+    sampled.append(points[-1])
+    return sampled
+
+
+class GrowthCharts(object):
+
+    cache_key = 'easynut-graphs-{}-{}'
+
+    def __init__(self):
+        self.config = None
+        self.definitions = {}
+
+    # Shared cache of the series, None if there is none
+    @staticmethod
+    def series_cache():
+        alias = getattr(settings, 'EASYNUT_GRAPH_CACHE', None)
+        if not alias:
+            return None
+        from django.core.cache import caches
+        return caches[alias]
+
+    # Key of the series of a patient in a form
+    # The MSF ID is hashed as the keys of some backends (memcached) cannot contain any character
+    @staticmethod
+    def key(table_id, msf_id):
+        return GrowthCharts.cache_key.format(table_id, hashlib.sha1('{}'.format(msf_id).encode('utf-8')).hexdigest())
+
+    # Charts of each form: {table_id: [(x field, x name, [(position, y field, y name), ...]), ...]}
+    # The position keeps the order of the fields of the form
+    def compile(self, tables_config):
+        if tables_config is self.config:
+            return self.definitions
+        definitions = {}
+        for tb in tables_config:
+            names = dict((fi['field'], fi['name']) for fi in tb['fields'])
+            axes = []
+            for position, fi in enumerate(tb['fields']):
+                if not (fi['type'] == FieldConfig.field_type_int and fi['select'] and 'grafico:' in fi['select'][0]):
+                    continue  # only int fields with select
+                xaxisfield = fi['select'][0][8:]
+                if xaxisfield not in names:
+                    continue
+                for axis in axes:
+                    if axis[0] == xaxisfield:
+                        axis[2].append((position, fi['field'], fi['name']))
+                        break
+                else:
+                    axes.append((xaxisfield, names[xaxisfield], [(position, fi['field'], fi['name'])]))
+            if axes:
+                definitions[tb['id']] = axes
+        self.config, self.definitions = tables_config, definitions
+        return definitions
+
+    def has_graphs(self, tables_config, table_id):
+        return table_id in self.compile(tables_config)
+
+    # Charts of a form for a patient: [[table_id, x name, y name, rows], ...]
+    # The first row contains the column names, per django-graphos convention
+    def table_series(self, db, tb, axes, msf_id):
+        graphs = []
+        c = db.cursor()
+        for xaxisfield, xaxisname, yaxes in axes:
+            rows = []
+            if msf_id:
+                sqlquery = 'SELECT 1000 * UNIX_TIMESTAMP({}), {} FROM {} WHERE campo_2 = %s ORDER BY {}'.format(
+                    xaxisfield, ', '.join(yaxisfield for position, yaxisfield, yaxisname in yaxes),
+                    tb['sql_table_config_name'], xaxisfield)
+                c.execute(sqlquery, [msf_id])
+                rows = c.fetchall()
+            for column, (position, yaxisfield, yaxisname) in enumerate(yaxes, 1):
+                graphlist = [[xaxisname, yaxisname]] + [[row[0], row[column]] for row in rows]
+                graphs.append((position, [tb['id'], xaxisname, yaxisname, graphlist]))
+        c.close()
+        return [graph for position, graph in sorted(graphs, key=lambda graph: graph[0])]
+
+    # Charts of all the forms for a patient, in the order of the forms
+    # A cached entry is only used if the definitions of the charts of the form did not change
+    def series(self, db, tables_config, msf_id):
+        definitions = self.compile(tables_config)
+        cache = self.series_cache() if msf_id else None
+        cached = cache.get_many([self.key(tb['id'], msf_id) for tb in tables_config
+                                 if tb['id'] in definitions]) if cache is not None else {}
+        graphs = []
+        for tb in tables_config:
+            if tb['id'] not in definitions:
+                continue
+            entry = cached.get(self.key(tb['id'], msf_id))
+            if entry is not None and entry[0] == definitions[tb['id']]:
+                table_graphs = entry[1]
+            else:
+                table_graphs = self.table_series(db, tb, definitions[tb['id']], msf_id)
+                if cache is not None:
+                    cache.set(self.key(tb['id'], msf_id), (definitions[tb['id']], table_graphs),
+                              getattr(settings, 'EASYNUT_GRAPH_CACHE_TTL', 300))
+            graphs += table_graphs
+        return graphs
+
+    # Range and number of points of the charts of the patient page
+    @staticmethod
+    def page_window():
+        window = getattr(settings, 'EASYNUT_GRAPH_WINDOW', None)
+        return {
+            'start': (time.time() - window * 86400) * 1000 if window else None,
+            'end': None,
+            'max_points': getattr(settings, 'EASYNUT_GRAPH_MAX_POINTS', 100),
+        }
+
+    # Chart restricted to the points between start and end (in ms, included), downsampled to max_points
+    # The points without date or value are left out
+    @staticmethod
+    def window(graph, start=None, end=None, max_points=None):
+        points = [row for row in graph[3][1:] if row[0] is not None and row[1] is not None
+                  and (start is None or row[0] >= start) and (end is None or row[0] <= end)]
+        if max_points:
+            points = lttb(points, max_points)
+        return graph[:3] + [graph[3][:1] + points]
+
+    # To call when a record of these patients in the form changed
+    def invalidate(self, table_id, msf_ids):
+        cache = self.series_cache()
+        if cache is not None and msf_ids:
+            cache.delete_many([self.key(table_id, msf_id) for msf_id in msf_ids if msf_id])
+
+
+growth_charts = GrowthCharts()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Small thread-safe LRU cache with an expiry time for the entries
+# The expiry bounds how long a change made by another worker can be missed
+
+from __future__ import unicode_literals
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+
+    missing = object()
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, self.missing)
+            if entry is self.missing or time.time() - entry[1] > self.ttl:
+                self.misses += 1
+                return default
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time())
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# Resolution between the MSF ID of a patient (tabla_1.campo_1) and its DB ID (tabla_1._id)
+# Exact lookups, answered from an in-process LRU cache when possible.
+# The cache is only cleared by the edits and deletes of this process, so its entries expire quickly
+# (EASYNUT_MSF_ID_CACHE_TTL) for the changes made by the other workers.
+# They rely on the unique index on tabla_1.campo_1, see the ensuremsfidindex command.
+# The MSF IDs of the new patients are given by MsfIdAllocator.
+
+from __future__ import unicode_literals
+import threading
+import time
+
+from django.conf import settings
+
+from .LRUCache import LRUCache
+
+
+class MsfIdResolver(object):
+
+    index_name = 'msf_id_unique'
+
+    def __init__(self):
+        self.patient_ids = None
+        self.msf_ids = None
+
+    def caches(self):
+        if self.patient_ids is None:
+            size = getattr(settings, 'EASYNUT_MSF_ID_CACHE_SIZE', 2000)
+            ttl = getattr(settings, 'EASYNUT_MSF_ID_CACHE_TTL', 15)
+            self.patient_ids = LRUCache(size, ttl)
+            self.msf_ids = LRUCache(size, ttl)
+        return self.patient_ids, self.msf_ids
+
+    # MSF IDs are numbers padded with zeros to 6 digits
+    # None if the entry is not a number
+    @staticmethod
+    def normalize(entry):
+        try:
+            return '{:06d}'.format(int(entry))
+        except (TypeError, ValueError):
+            return None
+
+    # DB ID of the patient with this MSF ID, None if there is none
+    # Without cached, the DB is always read, e.g. before redirecting to the patient
+    def patient_id(self, db, msf_id, cached=True):
+        if not msf_id:
+            return None
+        patient_ids, msf_ids = self.caches()
+        patient_id = patient_ids.get(msf_id)
+        if patient_id is None or not cached:
+            c = db.cursor()
+            c.execute('SELECT _id FROM tabla_1 WHERE campo_1 = %s LIMIT 1', [msf_id])
+            row = c.fetchone()
+            c.close()
+            if row:
+                if patient_id is not None and patient_id != row[0]:
+                    self.forget(patient_id)
+                patient_id = row[0]
+                self.remember(msf_id, patient_id)
+            elif patient_id is not None:
+                # Deleted or renumbered by another worker
+                self.forget(patient_id)
+                patient_ids.delete(msf_id)
+                patient_id = None
+        return patient_id
+
+    # MSF ID of the patient with this DB ID, None if there is none
+    def msf_id(self, db, patient_id):
+        patient_ids, msf_ids = self.caches()
+        msf_id = msf_ids.get(int(patient_id))
+        if msf_id is None:
+            c = db.cursor()
+            c.execute('SELECT campo_1 FROM tabla_1 WHERE _id = %s', [patient_id])
+            row = c.fetchone()
+            c.close()
+            if row and row[0]:
+                msf_id = row[0]
+                self.remember(msf_id, patient_id)
+        return msf_id
+
+    def remember(self, msf_id, patient_id):
+        patient_ids, msf_ids = self.caches()
+        patient_ids.set(msf_id, patient_id)
+        msf_ids.set(int(patient_id), msf_id)
+
+    # To call when a patient is edited or deleted
+    def forget(self, patient_id):
+        patient_ids, msf_ids = self.caches()
+        msf_id = msf_ids.get(int(patient_id))
+        msf_ids.delete(int(patient_id))
+        if msf_id is not None:
+            patient_ids.delete(msf_id)
+
+    # MSF IDs used by more than one patient
+    @staticmethod
+    def duplicates(db):
+        c = db.cursor()
+        c.execute('SELECT campo_1, COUNT(*) FROM tabla_1 WHERE campo_1 IS NOT NULL '
+                  'GROUP BY campo_1 HAVING COUNT(*) > 1')
+        rows = c.fetchall()
+        c.close()
+        return rows
+
+    @staticmethod
+    def has_unique_index(db):
+        c = db.cursor()
+        c.execute("SHOW INDEX FROM tabla_1 WHERE Column_name = 'campo_1' AND Non_unique = 0")
+        rows = c.fetchall()
+        c.close()
+        return bool(rows)
+
+    # Create the unique index on tabla_1.campo_1 if it is missing
+    # Returns False if it cannot be created because of duplicated MSF IDs
+    def ensure_unique_index(self, db):
+        if self.has_unique_index(db):
+            return True
+        if self.duplicates(db):
+            return False
+        c = db.cursor()
+        c.execute('ALTER TABLE tabla_1 ADD UNIQUE INDEX {} (campo_1)'.format(self.index_name))
+        c.close()
+        return True
+
+
+msf_id_resolver = MsfIdResolver()
+
+
+# Allocation of the MSF IDs of the new patients, from the easy_sequences table
+# "SET value = LAST_INSERT_ID(value + n)" increments the sequence under the lock of its row,
+# and LAST_INSERT_ID() returns the new value to this connection only, so two workers never get the same IDs.
+# A block of IDs can be reserved at once, e.g. for a tablet registering patients offline.
+# The allocation is committed at once to release the lock: the ID of a failed insert is lost, never given twice.
+# *TBC*#
+# The sequence starts after the highest MSF ID of tabla_1. The MSF IDs entered by hand
+# (edit of a patient, import) must be passed to seen() so that the sequence does not give them again.
+class MsfIdAllocator(object):
+
+    sequence = 'msf_id'
+    create_sql = ('CREATE TABLE IF NOT EXISTS easy_sequences ('
+                  'name VARCHAR(64) NOT NULL PRIMARY KEY, '
+                  'value BIGINT UNSIGNED NOT NULL)')
+    highest_sql = 'SELECT COALESCE(MAX(CAST(campo_1 AS UNSIGNED)), 0) FROM tabla_1'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = False
+        # Highest MSF ID of tabla_1 and when it was read
+        self.last = None
+        self.last_read = 0
+
+    # Create the sequence if it is missing, starting after the highest MSF ID
+    def create(self, db):
+        c = db.cursor()
+        c.execute(self.create_sql)
+        c.execute('INSERT IGNORE INTO easy_sequences (name, value) SELECT %s, ({})'.format(self.highest_sql),
+                  [self.sequence])
+        c.close()
+        db.commit()
+
+    # Move the sequence after MSF IDs entered by hand, to call in the transaction saving them
+    # ensure() must have been called before the transaction started, as creating the table commits it
+    def seen(self, db, msf_ids):
+        values = [int(msf_id) for msf_id in msf_ids if MsfIdResolver.normalize(msf_id) is not None]
+        if not values:
+            return
+        c = db.cursor()
+        c.execute('UPDATE easy_sequences SET value = GREATEST(value, %s) WHERE name = %s', [max(values), self.sequence])
+        c.close()
+
+    # The table is created once per process
+    # It commits the current transaction the first time, so it is called before any write
+    def ensure(self, db):
+        with self.lock:
+            if not self.ready:
+                self.create(db)
+                self.ready = True
+
+    # Reserve count MSF IDs, returned in order
+    def reserve(self, db, count=1):
+        if count < 1:
+            return []
+        self.ensure(db)
+        c = db.cursor()
+        c.execute('UPDATE easy_sequences SET value = LAST_INSERT_ID(value + %s) WHERE name = %s',
+                  [count, self.sequence])
+        c.execute('SELECT LAST_INSERT_ID()')
+        last = int(c.fetchone()[0])
+        c.close()
+        db.commit()
+        return [MsfIdResolver.normalize(value) for value in range(last - count + 1, last + 1)]
+
+    # Highest MSF ID of tabla_1, shown in the header of the pages
+    # Kept in memory and updated by the inserts of this process,
+    # read again after EASYNUT_LAST_ID_TTL seconds for the inserts of the other workers
+    def last_id(self, db):
+        with self.lock:
+            if self.last is not None and time.time() - self.last_read < getattr(settings, 'EASYNUT_LAST_ID_TTL', 60):
+                return self.last
+        c = db.cursor()
+        c.execute('SELECT MAX(campo_1) FROM tabla_1')
+        last = c.fetchone()[0] or 0
+        c.close()
+        with self.lock:
+            self.last, self.last_read = last, time.time()
+        return last
+
+    # To call once patients with these MSF IDs are saved
+    def inserted(self, msf_ids):
+        msf_ids = [msf_id for msf_id in msf_ids if MsfIdResolver.normalize(msf_id) is not None]
+        with self.lock:
+            if self.last is not None and msf_ids:
+                self.last = max([self.last] + msf_ids, key=lambda msf_id: int(msf_id))
+
+    # To call when a patient is deleted, the highest MSF ID is read again
+    def forget_last(self):
+        with self.lock:
+            self.last = None
+
+
+msf_id_allocator = MsfIdAllocator()
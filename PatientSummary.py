@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Summary of the latest facts of each patient, kept in the easy_patient_summary table
+# Used by the absents and defaulters reports and by the patient page.
+# Updated on each insert, edit and delete of a record.
+# Enabled with EASYNUT_PATIENT_SUMMARY = True once built with the rebuildpatientsummary command.
+# *TBC*#
+# As in ExternalExport, the forms and fields are hardcoded:
+# tabla_8 consultations, tabla_5 internal movements, tabla_4 discharges, tabla_17 absent calls
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+
+
+class PatientSummary(object):
+
+    create_sql = ('CREATE TABLE IF NOT EXISTS easy_patient_summary ('
+                  'msf_id VARCHAR(32) NOT NULL PRIMARY KEY, '
+                  'last_visit DATE NULL, '
+                  'next_appointment DATE NULL, '
+                  'next_appointment_visit DATE NULL, '
+                  'next_visit DATE NULL, '
+                  'discharges INT NOT NULL DEFAULT 0, '
+                  'last_discharge DATE NULL, '
+                  'last_im_out DATE NULL, '
+                  'last_transfer_out DATE NULL, '
+                  'last_absent_call DATE NULL, '
+                  'last_step_form VARCHAR(255) NULL, '
+                  'last_step_at DATETIME NULL)')
+
+    # Query of each fact: msf_id and value per patient
+    # {patient} restricts the query to one patient when refreshing
+    facts = [
+        # Date of the last consultation
+        ('last_visit',
+         "SELECT campo_2 AS msf_id, MAX(campo_1) AS value FROM tabla_8 "
+         "WHERE {patient} campo_1 IS NOT NULL AND campo_1 <> 'NULL' GROUP BY campo_2"),
+        # Latest appointment given in a consultation
+        ('next_appointment',
+         "SELECT campo_2 AS msf_id, MAX(campo_30) AS value FROM tabla_8 "
+         "WHERE {patient} campo_30 IS NOT NULL AND campo_30 <> 'NULL' GROUP BY campo_2"),
+        # Date of the consultation that gave the latest appointment
+        ('next_appointment_visit',
+         "SELECT c.campo_2 AS msf_id, MAX(c.campo_1) AS value FROM tabla_8 c "
+         "INNER JOIN (SELECT campo_2, MAX(campo_30) AS campo_30 FROM tabla_8 "
+         "WHERE {patient} campo_30 IS NOT NULL AND campo_30 <> 'NULL' GROUP BY campo_2) m "
+         "ON (c.campo_2 = m.campo_2 AND c.campo_30 = m.campo_30) GROUP BY c.campo_2"),
+        # Appointment of the last consultation, as displayed on the patient page
+        ('next_visit',
+         "SELECT c.campo_2 AS msf_id, MAX(c.campo_30) AS value FROM tabla_8 c "
+         "INNER JOIN (SELECT campo_2, MAX(timestamp) AS timestamp FROM tabla_8 "
+         "WHERE {patient} campo_7 IS NOT NULL GROUP BY campo_2) m "
+         "ON (c.campo_2 = m.campo_2 AND c.timestamp = m.timestamp) "
+         "WHERE c.campo_7 IS NOT NULL GROUP BY c.campo_2"),
+        ('discharges',
+         "SELECT campo_2 AS msf_id, COUNT(*) AS value FROM tabla_4 "
+         "WHERE {patient} TRUE GROUP BY campo_2"),
+        ('last_discharge',
+         "SELECT campo_2 AS msf_id, MAX(campo_1) AS value FROM tabla_4 "
+         "WHERE {patient} campo_1 IS NOT NULL AND campo_1 <> 'NULL' GROUP BY campo_2"),
+        ('last_im_out',
+         "SELECT campo_2 AS msf_id, MAX(campo_1) AS value FROM tabla_5 "
+         "WHERE {patient} campo_3 = 'IM-OUT' AND campo_1 IS NOT NULL AND campo_1 <> 'NULL' GROUP BY campo_2"),
+        ('last_transfer_out',
+         "SELECT campo_2 AS msf_id, MAX(campo_1) AS value FROM tabla_5 "
+         "WHERE {patient} campo_3 = 'Transfer out' AND campo_1 IS NOT NULL AND campo_1 <> 'NULL' GROUP BY campo_2"),
+        ('last_absent_call',
+         "SELECT campo_2 AS msf_id, MAX(campo_1) AS value FROM tabla_17 "
+         "WHERE {patient} campo_1 IS NOT NULL AND campo_1 <> 'NULL' GROUP BY campo_2"),
+    ]
+
+    @staticmethod
+    def enabled():
+        return getattr(settings, 'EASYNUT_PATIENT_SUMMARY', False)
+
+    # Latest form filled for the patient and when
+    # The latest timestamp of every form is read in a single UNION ALL query
+    @staticmethod
+    def last_step(c, msf_id, tables_config):
+        queries = []
+        params = []
+        for tablec in tables_config:
+            if tablec['id'] != '1':
+                queries.append('SELECT %s, MAX(timestamp) FROM {} WHERE campo_2 = %s'.format(
+                    tablec['sql_table_config_name']))
+                params += [tablec['name'], msf_id]
+        laststeps = {}
+        if queries:
+            c.execute(' UNION ALL '.join(queries), params)
+            for name, timestamp in c.fetchall():
+                if timestamp:
+                    laststeps[name] = timestamp
+        if laststeps:
+            form = max(laststeps, key=laststeps.get)
+            return form, laststeps[form]
+        return None, None
+
+    # Compute again the summary of a patient, to call after a record of the patient changed
+    def refresh(self, db, msf_id, tables_config):
+        if not msf_id:
+            return
+        c = db.cursor()
+        c.execute('SELECT 1 FROM tabla_1 WHERE campo_1 = %s LIMIT 1', [msf_id])
+        if c.fetchone() is None:
+            c.execute('DELETE FROM easy_patient_summary WHERE msf_id = %s', [msf_id])
+            c.close()
+            return
+        columns = ['msf_id']
+        values = [msf_id]
+        for column, sqlquery in self.facts:
+            sqlquery = sqlquery.format(patient='campo_2 = %s AND')
+            c.execute(sqlquery, [msf_id] * sqlquery.count('%s'))
+            row = c.fetchone()
+            columns.append(column)
+            values.append(row[1] if row else (0 if column == 'discharges' else None))
+        form, timestamp = self.last_step(c, msf_id, tables_config)
+        columns += ['last_step_form', 'last_step_at']
+        values += [form, timestamp]
+        c.execute('REPLACE INTO easy_patient_summary ({}) VALUES ({})'.format(
+            ', '.join(columns), ', '.join(['%s'] * len(columns))), values)
+        c.close()
+
+    # Build again the whole summary
+    def rebuild(self, db, tables_config):
+        c = db.cursor()
+        c.execute(self.create_sql)
+        c.execute('DELETE FROM easy_patient_summary')
+        c.execute('INSERT IGNORE INTO easy_patient_summary (msf_id) '
+                  'SELECT campo_1 FROM tabla_1 WHERE campo_1 IS NOT NULL')
+        for column, sqlquery in self.facts:
+            c.execute('UPDATE easy_patient_summary s INNER JOIN ({}) f ON (f.msf_id = s.msf_id) '
+                      'SET s.{} = f.value'.format(sqlquery.format(patient=''), column))
+        for tablec in tables_config:
+            if tablec['id'] != '1':
+                c.execute('UPDATE easy_patient_summary s INNER JOIN '
+                          '(SELECT campo_2 AS msf_id, MAX(timestamp) AS value FROM {} GROUP BY campo_2) f '
+                          'ON (f.msf_id = s.msf_id) '
+                          'SET s.last_step_form = %s, s.last_step_at = f.value '
+                          'WHERE s.last_step_at IS NULL OR f.value > s.last_step_at'.format(
+                              tablec['sql_table_config_name']), [tablec['name']])
+        db.commit()
+        c.close()
+
+    # Summary of a patient, as a dictionary, None if there is none
+    @staticmethod
+    def get(db, msf_id):
+        c = db.cursor()
+        c.execute('SELECT * FROM easy_patient_summary WHERE msf_id = %s', [msf_id])
+        row = c.fetchone()
+        columns = [column[0] for column in c.description]
+        c.close()
+        if row is None:
+            return None
+        return dict(zip(columns, row))
+
+
+patient_summary = PatientSummary()
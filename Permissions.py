@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Permissions of the users on the forms, from the easy_roles table
+# The permissions of a form are 4 bits (view, add, edit, delete).
+# The roles are compiled once per version of easy_roles (its checksum, probed at most
+# every EASYNUT_ROLES_PROBE_INTERVAL seconds), and the permissions of a user once per set of groups.
+# The easy_user dictionary keeps both the bits, for the checks of the views,
+# and the flags of each form, for the templates.
+
+from __future__ import unicode_literals
+import threading
+import time
+
+from django.conf import settings
+
+
+# User groups (careful, this has to be linked with the Django group table)
+# *TBC*#
+# The groups (or "roles") should not be defined here
+group_reg = 1
+group_adm = 2
+group_flo = 3
+group_nur = 4
+group_idc = 5
+group_pha = 6
+
+VIEW = 1
+ADD = 2
+EDIT = 4
+DELETE = 8
+ALL = VIEW | ADD | EDIT | DELETE
+
+# Bit of each permission, by its name in easy_user and in the templates
+bits = {
+    'view_table': VIEW,
+    'add_table': ADD,
+    'edit_table': EDIT,
+    'delete_table': DELETE,
+}
+
+
+class Permissions(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.last_probe = 0
+        # Bits of each group on each form: {group_id: {table_id: bits}}
+        self.roles = {}
+        # easy_user by (groups, forms)
+        self.users = {}
+
+    @staticmethod
+    def probe_interval():
+        return getattr(settings, 'EASYNUT_ROLES_PROBE_INTERVAL', 30)
+
+    # Version of easy_roles, compiling the roles again if it changed
+    def load(self, db):
+        with self.lock:
+            if self.version is None or time.time() - self.last_probe >= self.probe_interval():
+                c = db.cursor()
+                c.execute('CHECKSUM TABLE easy_roles')
+                version = '{}'.format(c.fetchone()[1])
+                self.last_probe = time.time()
+                if version != self.version:
+                    c.execute('SELECT group_id, table_id, view_table, add_table, edit_table, delete_table '
+                              'FROM easy_roles')
+                    self.roles = self.compile(c.fetchall())
+                    self.users = {}
+                    self.version = version
+                c.close()
+            return self.version
+
+    @staticmethod
+    def compile(easy_roles):
+        roles = {}
+        for group_id, table_id, view_table, add_table, edit_table, delete_table in easy_roles:
+            tables = roles.setdefault(group_id, {})
+            tables[str(table_id)] = tables.get(str(table_id), 0) \
+                | (VIEW if view_table == 1 else 0) | (ADD if add_table == 1 else 0) \
+                | (EDIT if edit_table == 1 else 0) | (DELETE if delete_table == 1 else 0)
+        return roles
+
+    # Permissions of a user in the groups group_ids, on the forms of tables_config_lite
+    def easy_user(self, db, group_ids, tables_config_lite):
+        version = self.load(db)
+        key = (frozenset(group_ids), tuple(str(tclk) for tclk, tclv in tables_config_lite))
+        with self.lock:
+            easy_user = self.users.get(key)
+            if easy_user is None:
+                easy_user = self.users[key] = self.build(version, key[0], key[1])
+        return easy_user
+
+    def build(self, version, group_ids, table_ids):
+        user_bits = dict((table_id, 0) for table_id in table_ids)
+        # Only for admin
+        if group_adm in group_ids:
+            user_bits = dict((table_id, ALL) for table_id in table_ids)
+        else:
+            for group_id in group_ids:
+                for table_id, table_bits in self.roles.get(group_id, {}).items():
+                    if table_id in user_bits:
+                        user_bits[table_id] |= table_bits
+        return {
+            'canExport': group_adm in group_ids,
+            # *TBC*#
+            # Not sure if the last ID is used anymore now that the system automatically provides an ID to the patient
+            'canLastId': group_adm in group_ids or group_idc in group_ids,
+            'rolesVersion': version,
+            'bits': user_bits,
+            'tables': dict((table_id, dict((name, bool(table_bits & bit)) for name, bit in bits.items()))
+                           for table_id, table_bits in user_bits.items()),
+        }
+
+    # Check a permission ('view_table', 'add_table'...) of the user on a form
+    @staticmethod
+    def check(easy_user, table_id, type):
+        return bool(easy_user['bits'].get(str(table_id), 0) & bits[type])
+
+
+permissions = Permissions()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Builder of the SQL statements of the DAO
+# The values are never written in the statements: they are %s parameters, escaped by the driver.
+# The names of the tables and columns come from the configuration of the forms and are checked.
+# A statement only depends on its shape (kind, table, columns), so it is built once and cached.
+# *TBC*#
+# MySQLdb (mysqlclient) has no server-side prepared statements: the parameters are escaped
+# and interpolated on the client, and MySQL still parses each statement.
+
+from __future__ import unicode_literals
+import re
+import threading
+
+
+class QueryError(Exception):
+    pass
+
+
+identifier_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$')
+
+# Dates are sent as text (YYYY-MM-DD), as the forms did before
+date_placeholder = "STR_TO_DATE(%s, '%%Y-%%m-%%d')"
+
+
+def identifier(name):
+    if not identifier_re.match(name or ''):
+        raise QueryError('Invalid identifier: {!r}'.format(name))
+    return name
+
+
+# Escape the wildcards of a LIKE pattern
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class QueryBuilder(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Statement of a shape, built with build() the first time
+    def statement(self, shape, build):
+        with self.lock:
+            sqlquery = self.statements.get(shape)
+            if sqlquery is not None:
+                self.hits += 1
+                return sqlquery
+            self.misses += 1
+        sqlquery = build()
+        with self.lock:
+            self.statements[shape] = sqlquery
+        return sqlquery
+
+    # columns: list of (column, is_date)
+    def insert(self, table, columns):
+        return self.statement(('insert', table, tuple(columns)), lambda: 'INSERT INTO {} ({}) VALUES ({})'.format(
+            identifier(table),
+            ', '.join(identifier(column) for column, is_date in columns),
+            ', '.join(date_placeholder if is_date else '%s' for column, is_date in columns),
+        ))
+
+    # INSERT of rows records at once, the parameters of the records one after the other
+    # Built from the statement of one record, so that only this one is cached
+    # (MySQLdb's executemany does not turn the STR_TO_DATE placeholders of the dates into multi-row INSERTs)
+    def insert_many(self, table, columns, rows):
+        sqlquery = self.insert(table, columns)
+        values = sqlquery[sqlquery.index(' VALUES ') + len(' VALUES '):]
+        return sqlquery + ''.join(', ' + values for row in range(rows - 1))
+
+    # columns: list of (column, is_date), the record is the last parameter
+    def update(self, table, columns):
+        return self.statement(('update', table, tuple(columns)), lambda: 'UPDATE {} SET {} WHERE _id = %s'.format(
+            identifier(table),
+            ', '.join('{} = {}'.format(identifier(column), date_placeholder if is_date else '%s')
+                      for column, is_date in columns),
+        ))
+
+    def delete(self, table):
+        return self.statement(('delete', table), lambda: 'DELETE FROM {} WHERE _id = %s'.format(identifier(table)))
+
+    # SELECT of columns with conditions (column, operator) on parameters, joined with AND
+    def select(self, table, columns, conditions=(), order_by=(), limit=None):
+        def build():
+            sqlquery = 'SELECT {} FROM {}'.format(', '.join(identifier(column) for column in columns),
+                                                 identifier(table))
+            if conditions:
+                sqlquery += ' WHERE ' + ' AND '.join(self.condition(column, operator)
+                                                     for column, operator in conditions)
+            if order_by:
+                sqlquery += ' ORDER BY ' + ', '.join(
+                    identifier(column.split(' ')[0]) + (' DESC' if column.endswith(' DESC') else '')
+                    for column in order_by)
+            if limit is not None:
+                sqlquery += ' LIMIT {:d}'.format(limit)
+            return sqlquery
+        return self.statement(('select', table, tuple(columns), tuple(conditions), tuple(order_by), limit), build)
+
+    # Condition on one parameter
+    # operators: =, <>, LIKE (the parameter is the whole pattern), date (= on a date given as text)
+    @staticmethod
+    def condition(column, operator):
+        if operator == 'date':
+            return '{} = {}'.format(identifier(column), date_placeholder)
+        if operator not in ('=', '<>', '<', '>', '<=', '>=', 'LIKE'):
+            raise QueryError('Invalid operator: {!r}'.format(operator))
+        return '{} {} %s'.format(identifier(column), operator)
+
+
+queries = QueryBuilder()
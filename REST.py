@@ -21,7 +21,7 @@ class RecordSerializer(serializers.Serializer):
         super(RecordSerializer, self).__init__(**kwargs)
         self.table_config = table_config
         self.daoobject = DAO.DAO()
-        self.daoobject.set_tables_config()
+        self.daoobject.load_tables_config()
         self.daoobject.set_tables_relationships()
 
         if showall:
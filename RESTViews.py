@@ -35,7 +35,7 @@ class RecordList(APIView):
     def __init__(self, **kwargs):
         super(RecordList, self).__init__(**kwargs)
         self.daoobject = DAO.DAO()
-        self.daoobject.set_tables_config()
+        self.daoobject.load_tables_config()
         self.daoobject.set_tables_relationships()
 
     def get(self, request, table_id):
@@ -89,7 +89,7 @@ class RecordDetail(APIView):
     def __init__(self, **kwargs):
         super(RecordDetail, self).__init__(**kwargs)
         self.daoobject = DAO.DAO()
-        self.daoobject.set_tables_config()
+        self.daoobject.load_tables_config()
         self.daoobject.set_tables_relationships()
 
     def get(self, request, table_id, pk):
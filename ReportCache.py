@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Cache of the generated reports (absents, defaulters)
+# A report is generated at most once every EASYNUT_REPORT_TTL seconds, or by the generatereports command.
+# Each generation is stored under a name made of the hash of its content, so a report being
+# downloaded is never overwritten. A json file next to it keeps when and how fast it was generated.
+# The previous generation is kept too, as it may have just been handed out while the new one was generated.
+
+from __future__ import unicode_literals
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+
+
+class ReportCache(object):
+
+    # A lock older than this is considered left by a crashed generation
+    lock_timeout = 600
+
+    @staticmethod
+    def reports_dir():
+        return os.path.join(settings.BASE_DIR, 'export', 'reports')
+
+    @staticmethod
+    def ttl():
+        return getattr(settings, 'EASYNUT_REPORT_TTL', 900)
+
+    def path(self, name):
+        return os.path.join(self.reports_dir(), name)
+
+    # Information on the last generation of a report, None if there is none
+    def info(self, name):
+        try:
+            with open(self.path(name + '.json')) as fh:
+                info = json.load(fh)
+        except (IOError, ValueError):
+            return None
+        if not os.path.exists(self.path(info['filename'])):
+            return None
+        return info
+
+    # Path of the report, generated with generate(path) if the cached one is too old
+    def get(self, name, generate):
+        info = self.info(name)
+        if info is not None and time.time() - info['generated'] < self.ttl():
+            return self.path(info['filename'])
+        return self.refresh(name, generate, stale=info)
+
+    # Generate the report again
+    # If another request is already generating it, serve the stale one or wait for the new one
+    def refresh(self, name, generate, stale=None):
+        if not os.path.isdir(self.reports_dir()):
+            os.makedirs(self.reports_dir())
+        lock = self.path(name + '.lock')
+        started = time.time()
+        while True:
+            token = self.acquire(lock)
+            if token is not None:
+                break
+            if stale is not None:
+                return self.path(stale['filename'])
+            time.sleep(0.5)
+            info = self.info(name)
+            if info is not None and info['generated'] >= started:
+                return self.path(info['filename'])
+        try:
+            previous = self.info(name)
+            fd, tmp = tempfile.mkstemp(dir=self.reports_dir(), prefix=name + '.', suffix='.tmp')
+            os.close(fd)
+            started = time.time()
+            try:
+                generate(tmp)
+            except Exception:
+                os.remove(tmp)
+                raise
+            duration = time.time() - started
+            sha1 = hashlib.sha1()
+            with open(tmp, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(65536), b''):
+                    sha1.update(chunk)
+            filename = '{}-{}.csv'.format(name, sha1.hexdigest()[:16])
+            os.rename(tmp, self.path(filename))
+            info = {'filename': filename, 'generated': time.time(), 'duration': duration}
+            with open(self.path(name + '.json.tmp'), 'w') as fh:
+                json.dump(info, fh)
+            os.rename(self.path(name + '.json.tmp'), self.path(name + '.json'))
+            # Remove the generations older than the previous one
+            keep = (filename, previous['filename'] if previous is not None else None)
+            for f in os.listdir(self.reports_dir()):
+                if f.startswith(name + '-') and f.endswith('.csv') and f not in keep:
+                    try:
+                        os.remove(self.path(f))
+                    except OSError:
+                        pass
+            return self.path(filename)
+        finally:
+            self.release(lock, token)
+
+    # Take the lock, return the token written in it, None if another generation holds it
+    def acquire(self, lock):
+        token = '{}-{}'.format(os.getpid(), uuid.uuid4().hex)
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            try:
+                os.write(fd, token.encode('ascii'))
+            finally:
+                os.close(fd)
+            return token
+        except OSError:
+            try:
+                if time.time() - os.path.getmtime(lock) > self.lock_timeout:
+                    os.remove(lock)
+            except OSError:
+                pass
+            return None
+
+    # Remove the lock if it is still the one taken with the token:
+    # a generation which overran lock_timeout may have lost it to another one
+    def release(self, lock, token):
+        try:
+            with open(lock, 'rb') as fh:
+                if fh.read() != token.encode('ascii'):
+                    return
+            os.remove(lock)
+        except (IOError, OSError):
+            pass
+
+
+report_cache = ReportCache()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Process-wide registry of the configuration of the forms
+# The configuration is built once per schema version and shared by all the requests.
+# If EASYNUT_SCHEMA_CACHE names a Django cache (memcached, file based, ...),
+# the configuration is also shared by all the workers through it.
+
+from __future__ import unicode_literals
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+
+
+class SchemaRegistry(object):
+
+    # Bump the layout when the structure of tables_config changes
+    layout = 2
+    cache_key = 'easynut-schema-{}-{}'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.tables_config = None
+        self.tables_config_lite = None
+        self.last_probe = 0
+
+    # Seconds during which the known version is trusted without probing the DB
+    @staticmethod
+    def probe_interval():
+        return getattr(settings, 'EASYNUT_SCHEMA_PROBE_INTERVAL', 30)
+
+    # Shared backend, if any
+    @staticmethod
+    def shared_cache():
+        alias = getattr(settings, 'EASYNUT_SCHEMA_CACHE', None)
+        if not alias:
+            return None
+        from django.core.cache import caches
+        return caches[alias]
+
+    # Compute the version of the schema
+    # CHECKSUM TABLE is cheap on "tablas" and the "tabla_N_des" tables as they are small
+    @staticmethod
+    def probe(db):
+        c = db.cursor()
+        c.execute('SELECT tabla_id FROM tablas ORDER BY tabla_id')
+        tables = ['tablas'] + ['tabla_{}_des'.format(row[0]) for row in c.fetchall()]
+        c.execute('CHECKSUM TABLE {}'.format(', '.join(tables)))
+        checksums = c.fetchall()
+        c.close()
+        return hashlib.sha1(repr(checksums).encode('utf-8')).hexdigest()[:12]
+
+    # Set the configuration of the forms on the DAO object, building it only if the schema changed
+    def load(self, daoobject):
+        with self.lock:
+            if self.version is None or time.time() - self.last_probe >= self.probe_interval():
+                version = self.probe(daoobject.db)
+                self.last_probe = time.time()
+                if version != self.version:
+                    self.refresh(daoobject, version)
+            daoobject.tables_config = self.tables_config
+            daoobject.tables_config_lite = self.tables_config_lite
+            return self.version
+
+    def refresh(self, daoobject, version):
+        cache = self.shared_cache()
+        shared = cache.get(self.cache_key.format(self.layout, version)) if cache is not None else None
+        if shared:
+            self.tables_config, self.tables_config_lite = shared
+        else:
+            self.tables_config = daoobject.set_tables_config()
+            self.tables_config_lite = daoobject.tables_config_lite
+            if cache is not None:
+                cache.set(self.cache_key.format(self.layout, version), (self.tables_config, self.tables_config_lite), None)
+        self.version = version
+
+    # Force the next load to probe the DB
+    def invalidate(self):
+        with self.lock:
+            self.last_probe = 0
+
+
+schema_registry = SchemaRegistry()
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# Index of the words of the searchable fields ("buscar") of the forms, used by the search function
+# EASYNUT_SEARCH_INDEX chooses the index:
+#   - False: no index, the search scans the tables with LIKE '%...%' (default)
+#   - 'table': words kept in the easy_search_index table (run the rebuildsearchindex command first)
+#   - 'memory': words kept in memory, built from the DB on first use (tests, single process)
+# A keyword matches the records having a word that starts with it. The numbers are also indexed without
+# their leading zeros, so that a part of a padded MSF ID ("123" for "000123", see MsfIdResolver.normalize)
+# finds it. A keyword without any word (e.g. "-") cannot be looked up in the index, the search scans
+# the tables for it as without index.
+
+from __future__ import unicode_literals
+from collections import defaultdict
+import bisect
+import re
+import threading
+
+from django.conf import settings
+
+
+# Words of a value
+def words(value):
+    if value is None:
+        return set()
+    if not isinstance(value, basestring):
+        value = str(value)
+    return set(word[:64] for word in re.findall(r'\w+', value.lower(), re.UNICODE))
+
+
+# Tokens indexed for a value: its words, and its numbers without their leading zeros
+def tokenize(value):
+    tokens = words(value)
+    return tokens | set(token.lstrip('0') for token in tokens if token.isdigit() and token.lstrip('0'))
+
+
+# Prefixes to look up for each word of a keyword, a record matching the keyword when it matches
+# one of the prefixes of each word
+def keyword_prefixes(keyword):
+    prefixes = []
+    for word in sorted(words(keyword)):
+        if word.isdigit() and word.lstrip('0') and word.lstrip('0') != word:
+            prefixes.append((word, word.lstrip('0')))
+        else:
+            prefixes.append((word,))
+    return prefixes
+
+
+# Fields of a form covered by the index
+def searchable_fields(tablec):
+    return [fieldc['field_id'] for fieldc in tablec['fields'] if fieldc['find']]
+
+
+class TableSearchIndex(object):
+
+    create_sql = ('CREATE TABLE IF NOT EXISTS easy_search_index ('
+                  'table_id VARCHAR(16) NOT NULL, '
+                  'record_id INT NOT NULL, '
+                  'token VARCHAR(64) NOT NULL, '
+                  'PRIMARY KEY (table_id, token, record_id), '
+                  'KEY record (table_id, record_id))')
+
+    # Index again a record after it has been added or edited
+    def refresh(self, db, tablec, record_id):
+        self.remove(db, tablec['id'], record_id)
+        fields = searchable_fields(tablec)
+        if not fields:
+            return
+        c = db.cursor()
+        sqlquery = 'SELECT {} FROM {} WHERE _id = %s'.format(', '.join(fields), tablec['sql_table_config_name'])
+        c.execute(sqlquery, [record_id])
+        row = c.fetchone()
+        if row:
+            tokens = set()
+            for value in row:
+                tokens |= tokenize(value)
+            c.executemany('INSERT IGNORE INTO easy_search_index (table_id, record_id, token) VALUES (%s, %s, %s)',
+                          [(tablec['id'], record_id, token) for token in tokens])
+        c.close()
+
+    def remove(self, db, table_id, record_id):
+        c = db.cursor()
+        c.execute('DELETE FROM easy_search_index WHERE table_id = %s AND record_id = %s', [table_id, record_id])
+        c.close()
+
+    # Index the records of a form added after the record since_id, e.g. by a bulk insert
+    def index_new(self, db, tablec, since_id):
+        fields = searchable_fields(tablec)
+        if not fields:
+            return
+        c = db.cursor()
+        c.execute('SELECT _id, {} FROM {} WHERE _id > %s'.format(', '.join(fields), tablec['sql_table_config_name']),
+                  [since_id])
+        entries = []
+        for row in c.fetchall():
+            tokens = set()
+            for value in row[1:]:
+                tokens |= tokenize(value)
+            entries += [(tablec['id'], row[0], token) for token in tokens]
+        for start in range(0, len(entries), 1000):
+            c.executemany('INSERT IGNORE INTO easy_search_index (table_id, record_id, token) VALUES (%s, %s, %s)',
+                          entries[start:start + 1000])
+        c.close()
+
+    # SQL condition and parameters matching the records of a form containing the keyword,
+    # None if the keyword has no word
+    def condition(self, table_id, keyword):
+        conditions = []
+        params = []
+        for prefixes in keyword_prefixes(keyword):
+            conditions.append('_id IN (SELECT record_id FROM easy_search_index WHERE table_id = %s AND ({}))'.format(
+                ' OR '.join('token LIKE %s' for prefix in prefixes)))
+            params += [table_id] + [prefix.replace('\\', '\\\\').replace('_', '\\_') + '%' for prefix in prefixes]
+        if not conditions:
+            return None
+        return ' and '.join(conditions), params
+
+    def rebuild(self, db, tables_config):
+        c = db.cursor()
+        c.execute(self.create_sql)
+        for tablec in tables_config:
+            c.execute('DELETE FROM easy_search_index WHERE table_id = %s', [tablec['id']])
+            fields = searchable_fields(tablec)
+            if not fields:
+                continue
+            c.execute('SELECT _id, {} FROM {}'.format(', '.join(fields), tablec['sql_table_config_name']))
+            entries = []
+            for row in c.fetchall():
+                tokens = set()
+                for value in row[1:]:
+                    tokens |= tokenize(value)
+                entries += [(tablec['id'], row[0], token) for token in tokens]
+            for start in range(0, len(entries), 1000):
+                c.executemany('INSERT IGNORE INTO easy_search_index (table_id, record_id, token) VALUES (%s, %s, %s)',
+                              entries[start:start + 1000])
+            db.commit()
+        c.close()
+
+
+class MemorySearchIndex(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = False
+        # (table_id, token) -> record ids
+        self.records = defaultdict(set)
+        # (table_id, record_id) -> tokens
+        self.tokens = {}
+        # table_id -> sorted tokens, to look up the tokens starting with a prefix
+        self.vocabulary = defaultdict(list)
+
+    # To call with the lock held
+    def add(self, table_id, record_id, row):
+        tokens = set()
+        for value in row:
+            tokens |= tokenize(value)
+        self.tokens[(table_id, record_id)] = tokens
+        for token in tokens:
+            if (table_id, token) not in self.records:
+                bisect.insort(self.vocabulary[table_id], token)
+            self.records[(table_id, token)].add(record_id)
+
+    # To call with the lock held
+    def drop(self, table_id, record_id):
+        for token in self.tokens.pop((table_id, record_id), ()):
+            record_ids = self.records[(table_id, token)]
+            record_ids.discard(record_id)
+            if not record_ids:
+                del self.records[(table_id, token)]
+                vocabulary = self.vocabulary[table_id]
+                del vocabulary[bisect.bisect_left(vocabulary, token)]
+
+    # Records of a form having a token starting with the prefix, to call with the lock held
+    def matches(self, table_id, prefix):
+        vocabulary = self.vocabulary[table_id]
+        record_ids = set()
+        i = bisect.bisect_left(vocabulary, prefix)
+        while i < len(vocabulary) and vocabulary[i].startswith(prefix):
+            record_ids |= self.records[(table_id, vocabulary[i])]
+            i += 1
+        return record_ids
+
+    def refresh(self, db, tablec, record_id):
+        self.remove(db, tablec['id'], record_id)
+        fields = searchable_fields(tablec)
+        if not fields:
+            return
+        c = db.cursor()
+        sqlquery = 'SELECT {} FROM {} WHERE _id = %s'.format(', '.join(fields), tablec['sql_table_config_name'])
+        c.execute(sqlquery, [record_id])
+        row = c.fetchone()
+        c.close()
+        if row:
+            with self.lock:
+                self.add(tablec['id'], int(record_id), row)
+
+    def remove(self, db, table_id, record_id):
+        with self.lock:
+            self.drop(table_id, int(record_id))
+
+    # Index the records of a form added after the record since_id, e.g. by a bulk insert
+    def index_new(self, db, tablec, since_id):
+        fields = searchable_fields(tablec)
+        if not fields:
+            return
+        c = db.cursor()
+        c.execute('SELECT _id, {} FROM {} WHERE _id > %s'.format(', '.join(fields), tablec['sql_table_config_name']),
+                  [since_id])
+        rows = c.fetchall()
+        c.close()
+        for row in rows:
+            self.remove(db, tablec['id'], row[0])
+            with self.lock:
+                self.add(tablec['id'], int(row[0]), row[1:])
+
+    def condition(self, table_id, keyword):
+        ids = None
+        with self.lock:
+            for prefixes in keyword_prefixes(keyword):
+                matches = set()
+                for prefix in prefixes:
+                    matches |= self.matches(table_id, prefix)
+                ids = matches if ids is None else ids & matches
+        if ids is None:
+            return None
+        if not ids:
+            return 'FALSE', []
+        return '_id IN ({})'.format(', '.join(str(record_id) for record_id in sorted(ids))), []
+
+    # Index again the records of the forms of tables_config, the other forms are kept
+    def rebuild(self, db, tables_config):
+        c = db.cursor()
+        table_ids = set(tablec['id'] for tablec in tables_config)
+        with self.lock:
+            for table_id, record_id in list(self.tokens):
+                if table_id in table_ids:
+                    self.drop(table_id, record_id)
+            for tablec in tables_config:
+                fields = searchable_fields(tablec)
+                if not fields:
+                    continue
+                c.execute('SELECT _id, {} FROM {}'.format(', '.join(fields), tablec['sql_table_config_name']))
+                for row in c.fetchall():
+                    self.add(tablec['id'], row[0], row[1:])
+            self.built = True
+        c.close()
+
+
+table_search_index = TableSearchIndex()
+memory_search_index = MemorySearchIndex()
+
+
+# Index configured for the app, None if the search does not use an index
+def get_search_index(db=None, tables_config=None):
+    backend = getattr(settings, 'EASYNUT_SEARCH_INDEX', False)
+    if backend == 'table':
+        return table_search_index
+    if backend == 'memory':
+        if not memory_search_index.built and db is not None:
+            memory_search_index.rebuild(db, tables_config)
+        return memory_search_index
+    return None
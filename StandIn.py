@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# In-memory SQLite stand-in of the easynutdata DB, for the benchmarks and the tests
+# The connection counts the queries and can wait a fixed latency before each of them,
+# to play the round-trips to MySQL. The statements of the DAO are run as they are,
+# their %s parameters are turned into ? (and %% into %). The values looking like a timestamp are read
+# as datetimes, as MySQLdb returns the TIMESTAMP columns and the expressions on them (MAX(timestamp)...).
+# *TBC*#
+# Only the SQL the benchmarked code uses is supported: STR_TO_DATE only with '%Y-%m-%d', no NOW(), UNIX_TIMESTAMP...
+
+from __future__ import unicode_literals
+import datetime
+import re
+import sqlite3
+import time
+
+from .EasyDBObjects import FieldConfig
+
+
+timestamp_pattern = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$')
+
+
+# Row as MySQLdb returns it
+def convert_row(row):
+    if row is None:
+        return None
+    return tuple(datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+                 if isinstance(value, type('')) and timestamp_pattern.match(value) else value for value in row)
+
+
+# STR_TO_DATE of MySQL, for the formats which are the same in Python
+def str_to_date(value, fmt):
+    try:
+        return datetime.datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+
+class StandInCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.db.cursor()
+
+    def execute(self, sqlquery, params=None):
+        self.connection.queries += 1
+        if self.connection.latency:
+            time.sleep(self.connection.latency)
+        if params is None:
+            return self.cursor.execute(sqlquery)
+        return self.cursor.execute(sqlquery.replace('%s', '?').replace('%%', '%'), list(params))
+
+    def fetchone(self):
+        return convert_row(self.cursor.fetchone())
+
+    def fetchall(self):
+        return [convert_row(row) for row in self.cursor.fetchall()]
+
+    def __iter__(self):
+        return (convert_row(row) for row in self.cursor)
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+
+class StandInConnection(object):
+
+    # latency: seconds waited before each query
+    def __init__(self, latency=0):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.create_function('STR_TO_DATE', 2, str_to_date)
+        self.latency = latency
+        self.queries = 0
+
+    def cursor(self, *args):
+        return StandInCursor(self)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    # Create forms 1 to forms with fields fields each, the first ones of each form being:
+    #   - form 1 (Bio data): campo_1 MSF ID
+    #   - other forms: campo_1 date of the visit, campo_2 MSF ID
+    # The last field of each form is the one the exports replace by the user and the timestamp.
+    def seed_forms(self, forms, fields):
+        types = ['entero', 'texto', 'select', 'fecha', 'radio', 'notes']
+        c = self.db.cursor()
+        c.execute('CREATE TABLE tablas (tabla_id TEXT, presentador TEXT, registros INTEGER)')
+        for table_id in range(1, forms + 1):
+            c.execute('INSERT INTO tablas VALUES (?, ?, ?)', ['{}'.format(table_id), 'Form {}'.format(table_id), table_id])
+            c.execute('CREATE TABLE tabla_{}_des ({})'.format(table_id, ', '.join(FieldConfig.attributes)))
+            for position in range(1, fields + 1):
+                field = 'campo_{}'.format(position)
+                if table_id == 1 and position == 1 or table_id != 1 and position == 2:
+                    name, type = 'MSF ID', 'texto'
+                elif table_id != 1 and position == 1:
+                    name, type = 'Date', 'fecha'
+                else:
+                    name, type = 'Field {}'.format(position), types[position % len(types)]
+                attributes = {
+                    '_id': position,
+                    'campo': field,
+                    'campo_id': field,
+                    'presentador': name,
+                    'tipo': type,
+                    'varios': 'a, b, c' if type in ('select', 'radio') else None,
+                    'listado': 'true' if position <= 3 else 'false',
+                    'detalle': 'true',
+                    'buscar': 'true' if position <= 2 else 'false',
+                    'nuevaLinea': 'false',
+                    'editable': 'true',
+                    'pos': position,
+                    'usar': 'true',
+                    'relacionado': 'false',
+                }
+                c.execute('INSERT INTO tabla_{}_des ({}) VALUES ({})'.format(
+                    table_id, ', '.join(attributes), ', '.join('?' for attribute in attributes)),
+                    list(attributes.values()))
+            c.execute('CREATE TABLE tabla_{} (_id INTEGER PRIMARY KEY, {}, user TEXT, timestamp TIMESTAMP)'.format(
+                table_id, ', '.join('campo_{}'.format(position) for position in range(1, fields + 1))))
+        c.close()
+        self.db.commit()
+
+    # Add patients records to form 1 and records per patient to each other form
+    def seed_records(self, forms, fields, patients, records):
+        c = self.db.cursor()
+        for patient in range(1, patients + 1):
+            msf_id = '{:06d}'.format(patient)
+            values = [msf_id] + ['{}'.format(position) for position in range(2, fields + 1)]
+            c.execute('INSERT INTO tabla_1 VALUES (NULL, {}, ?, ?)'.format(', '.join('?' for value in values)),
+                      values + ['admin', '2017-01-01 10:00:00'])
+            for table_id in range(2, forms + 1):
+                for record in range(records):
+                    day = '2017-{:02d}-{:02d}'.format(1 + record // 28 % 12, 1 + record % 28)
+                    values = [day, msf_id] + ['{}'.format(position) for position in range(3, fields + 1)]
+                    c.execute('INSERT INTO tabla_{} VALUES (NULL, {}, ?, ?)'.format(
+                        table_id, ', '.join('?' for value in values)),
+                        values + ['admin', '{} {:02d}:00:00'.format(day, table_id % 24)])
+        c.close()
+        self.db.commit()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Compare the ways of reading the last step of a patient, on a seeded SQLite stand-in of the DB (see StandIn):
+#   - per form: one SELECT MAX(timestamp) per form, as addLastStepSingle did before
+#   - union all: one UNION ALL query, see PatientSummary.last_step
+#   - folded: subqueries folded into the query of the record, see ExternalFields.LastStepField
+# --latency adds a fixed time to each query, to play the round-trips to MySQL
+from __future__ import unicode_literals
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...ExternalFields import LastStepField, registry
+from ...PatientSummary import patient_summary
+from ...StandIn import StandInConnection
+from .benchmarkschema import bulk_config
+
+
+def per_form(db, tables_config, patient):
+    c = db.cursor()
+    c.execute('SELECT campo_1 FROM tabla_1 WHERE _id = %s', [patient])
+    msf_id = c.fetchone()[0]
+    laststeps = {}
+    for tablec in tables_config:
+        if tablec['id'] != '1':
+            c.execute('SELECT MAX(timestamp) FROM {} WHERE campo_2 = %s'.format(tablec['sql_table_config_name']),
+                      [msf_id])
+            timestamp = c.fetchone()[0]
+            if timestamp:
+                laststeps[tablec['name']] = timestamp
+    c.close()
+    return max(laststeps, key=laststeps.get) if laststeps else None
+
+
+def union_all(db, tables_config, patient):
+    c = db.cursor()
+    c.execute('SELECT campo_1 FROM tabla_1 WHERE _id = %s', [patient])
+    msf_id = c.fetchone()[0]
+    form, timestamp = patient_summary.last_step(c, msf_id, tables_config)
+    c.close()
+    return form
+
+
+def folded(db, tables_config, patient):
+    select = registry.select([LastStepField()], tables_config, 'r.campo_1')
+    c = db.cursor()
+    c.execute('SELECT r.campo_1, {} FROM tabla_1 r WHERE r._id = %s LIMIT 1'.format(
+        ', '.join(expression + ' AS ' + alias for alias, expression in select)), [patient])
+    row = c.fetchone()
+    c.close()
+    laststeps = dict((tablec['name'], timestamp) for tablec in tables_config
+                     for (alias, expression), timestamp in zip(select, row[1:])
+                     if alias == 'step_' + tablec['id'] and timestamp)
+    return max(laststeps, key=laststeps.get) if laststeps else None
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmark the reading of the last step of a patient'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--forms', default='5,20,50', help='Numbers of forms to compare, separated by commas')
+        parser.add_argument('--patients', type=int, default=200, help='Number of patients')
+        parser.add_argument('--records', type=int, default=5, help='Records per patient in each form')
+        parser.add_argument('--latency', type=float, default=0.0, help='Milliseconds added to each query')
+        parser.add_argument('--pages', type=int, default=50, help='Number of patient pages to average')
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:>6} {:<10} {:>8} {:>10}'.format('forms', 'method', 'queries', 'ms'))
+        for forms in [int(forms) for forms in options['forms'].split(',')]:
+            db = StandInConnection(options['latency'] / 1000.0)
+            db.seed_forms(forms, 5)
+            db.seed_records(forms, 5, options['patients'], options['records'])
+            tables_config = bulk_config(db)
+            patients = [1 + page % options['patients'] for page in range(options['pages'])]
+            results = {}
+            for name, method in (('per form', per_form), ('union all', union_all), ('folded', folded)):
+                db.queries = 0
+                started = time.time()
+                results[name] = [method(db, tables_config, patient) for patient in patients]
+                elapsed = (time.time() - started) / len(patients)
+                self.stdout.write('{:>6} {:<10} {:>8} {:>10.2f}'.format(
+                    forms, name, db.queries // len(patients), elapsed * 1000))
+            if not results['per form'] == results['union all'] == results['folded']:
+                self.stderr.write('The methods do not give the same last steps with {} forms'.format(forms))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Compare the loading of the configuration of the forms field attribute by field attribute (as it was done before)
+# and in one query per form (DAO.set_tables_config), on a seeded SQLite stand-in of the DB, see StandIn
+# --latency adds a fixed time to each query, to play the round-trips to MySQL
+from __future__ import unicode_literals
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...DAO import DAO
+from ...EasyDBObjects import FieldConfig
+from ...StandIn import StandInConnection
+
+
+# Configuration of the forms read attribute by attribute, as DAO.set_tables_config did before
+def per_attribute_config(db):
+    tables_config = []
+    c = db.cursor()
+    c.execute('select tabla_id, presentador from tablas')
+    for k, v in c.fetchall():
+        tablec = {'id': k, 'name': v, 'fields': []}
+        c.execute('SELECT _id FROM tabla_{}_des'.format(k))
+        for field_id in c.fetchall():
+            fielddic = {}
+            for attributek, attributev in FieldConfig.attributes.items():
+                c.execute('select {} from tabla_{}_des where _id = {}'.format(attributek, k, field_id[0]))
+                fielddic[attributev] = FieldConfig.convert_attribute(attributev, c.fetchone()[0])
+            tablec['fields'].append(fielddic)
+        tables_config.append(tablec)
+    c.close()
+    return tables_config
+
+
+# Configuration of the forms read by the DAO
+# The DAO is not initialised, so that it does not take a connection from the pool
+def bulk_config(db):
+    daoobject = DAO.__new__(DAO)
+    daoobject.db = db
+    return daoobject.set_tables_config()
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmark the loading of the configuration of the forms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--forms', type=int, default=20, help='Number of forms')
+        parser.add_argument('--fields', type=int, default=60, help='Number of fields per form')
+        parser.add_argument('--latency', type=float, default=0.0, help='Milliseconds added to each query')
+        parser.add_argument('--repeat', type=int, default=3, help='Number of loads to average')
+
+    def handle(self, *args, **options):
+        db = StandInConnection(options['latency'] / 1000.0)
+        db.seed_forms(options['forms'], options['fields'])
+        results = {}
+        for name, load in (('per attribute', per_attribute_config), ('bulk', bulk_config)):
+            db.queries = 0
+            started = time.time()
+            for i in range(options['repeat']):
+                results[name] = load(db)
+            elapsed = (time.time() - started) / options['repeat']
+            self.stdout.write('{:<14} {:>8} queries {:>10.1f} ms'.format(
+                name, db.queries // options['repeat'], elapsed * 1000))
+        if [tablec['fields'] for tablec in results['per attribute']] != \
+                [tablec['fields'] for tablec in results['bulk']]:
+            raise CommandError('The two loaders do not give the same configuration')
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Check that tabla_1.campo_1 (MSF ID) has a unique index, and create it if it is missing
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...ConnectionPool import pool
+from ...MsfIds import msf_id_resolver
+
+
+class Command(BaseCommand):
+
+    help = 'Ensure the MSF IDs of the patients have a unique index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report, do not create the index')
+
+    def handle(self, *args, **options):
+        db = pool.connection()
+        try:
+            if msf_id_resolver.has_unique_index(db):
+                self.stdout.write('The unique index on the MSF IDs exists')
+                return
+            duplicates = msf_id_resolver.duplicates(db)
+            for msf_id, count in duplicates:
+                self.stderr.write('MSF ID {} is used by {} patients'.format(msf_id, count))
+            if duplicates:
+                raise CommandError('Fix the duplicated MSF IDs before creating the unique index')
+            if options['check']:
+                raise CommandError('The unique index on the MSF IDs is missing')
+            msf_id_resolver.ensure_unique_index(db)
+            self.stdout.write('Unique index on the MSF IDs created')
+        finally:
+            pool.release()
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generate again the cached reports, to schedule (cron) so that the downloads are always served from the cache
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ...ConnectionPool import pool
+from ...ExternalExport import ExternalExport
+from ...ReportCache import report_cache
+
+
+class Command(BaseCommand):
+
+    help = 'Generate again the absents and defaulters reports'
+
+    def handle(self, *args, **options):
+        extE = ExternalExport()
+        try:
+            for name, generate in (('Absents', extE.getAbsents), ('Defaulters', extE.getDefaulters)):
+                report_cache.refresh(name, generate)
+                info = report_cache.info(name)
+                self.stdout.write('{} generated in {:.1f} s: {}'.format(name, info['duration'], info['filename']))
+        finally:
+            pool.release()
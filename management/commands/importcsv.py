@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Import the records of a form from a csv file, in the layout of the raw export (see DAO.generateExport):
+# one column per field of the form, by its name, then the user and the timestamp
+# The MSF ID of the new patients (form 1) is given when its column is empty or missing.
+from __future__ import unicode_literals
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...ConnectionPool import pool
+from ...DAO import DAO
+
+
+class Command(BaseCommand):
+
+    help = 'Import the records of a form from a csv file of the raw export'
+
+    def add_arguments(self, parser):
+        parser.add_argument('table_id', help='Id of the form')
+        parser.add_argument('path', help='csv file to import')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Records inserted per transaction')
+
+    def handle(self, *args, **options):
+        daoobject = DAO()
+        try:
+            daoobject.load_tables_config()
+            tables = [tablec for tablec in daoobject.tables_config if tablec['id'] == options['table_id']]
+            if not tables:
+                raise CommandError('Unknown form: {}'.format(options['table_id']))
+            rows, lines = self.read(tables[0], options['path'])
+            inserted, errors = daoobject.bulk_insert(options['table_id'], rows, options['chunk_size'])
+            for index, error in errors:
+                self.stderr.write('Line {}: {}'.format(lines[index], error))
+            self.stdout.write('{} records imported, {} in error'.format(inserted, len(errors)))
+        finally:
+            pool.release()
+
+    # Fields of each record ([field, value, type], as for DAO.insertrecord) and the line it comes from
+    @staticmethod
+    def read(tablec, path):
+        # *TBC*#
+        # The columns are matched by the names of the fields, which are not checked to be unique
+        fields = dict((fieldc['name'], [fieldc['field_id'], fieldc['type']]) for fieldc in tablec['fields'][:-1])
+        fields['User'] = ['user', '2']
+        fields['Timestamp'] = ['timestamp', '2']
+        rows = []
+        lines = []
+        with open(path, 'rb') as mycsv:
+            reader = csv.reader(mycsv)
+            header = [name.decode('utf-8') if isinstance(name, bytes) else name for name in next(reader)]
+            unknown = [name for name in header if name not in fields]
+            if unknown:
+                raise CommandError('Unknown columns: {}'.format(', '.join(unknown)))
+            for row in reader:
+                fieldstoadd = []
+                for name, value in zip(header, row):
+                    if isinstance(value, bytes):
+                        value = value.decode('utf-8')
+                    # The default timestamp of the table is kept when none is given
+                    if name == 'Timestamp' and not value:
+                        continue
+                    fieldstoadd.append([fields[name][0], value or None, fields[name][1]])
+                if tablec['id'] == '1' and 'campo_1' not in [field[0] for field in fieldstoadd]:
+                    fieldstoadd.append(['campo_1', None, '2'])
+                rows.append(fieldstoadd)
+                lines.append(reader.line_num)
+        return rows, lines
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Export the changes since the previous incremental export, to schedule (cron) before the nightly sync
+# Set EASYNUT_INCREMENTAL_EXPORT = True once this command has run, so that the changes are logged
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ...ConnectionPool import pool
+from ...DAO import DAO
+from ...Exporter import IncrementalExport
+
+
+class Command(BaseCommand):
+
+    help = 'Export the rows added, edited and deleted since the previous incremental export'
+
+    def handle(self, *args, **options):
+        daoobject = DAO()
+        try:
+            daoobject.load_tables_config()
+            export = IncrementalExport(daoobject.tables_config)
+            path = export.run(daoobject.db)
+            manifest = export.manifest()
+            for table_id, table in sorted(manifest['tables'].items()):
+                self.stdout.write('{}: {} rows'.format(table['name'], table['rows']))
+            self.stdout.write('Deleted records: {}'.format(manifest['changes']['deleted']))
+            self.stdout.write(path)
+        finally:
+            pool.release()
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Build again the easy_patient_summary table from the forms
+# To run before setting EASYNUT_PATIENT_SUMMARY = True
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ...ConnectionPool import pool
+from ...DAO import DAO
+from ...PatientSummary import patient_summary
+
+
+class Command(BaseCommand):
+
+    help = 'Build again the summary of the latest facts of each patient'
+
+    def handle(self, *args, **options):
+        daoobject = DAO()
+        daoobject.load_tables_config()
+        patient_summary.rebuild(daoobject.db, daoobject.tables_config)
+        pool.release()
+        self.stdout.write('Summary of the patients built')
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Build again the easy_search_index table from the searchable fields of the forms
+# To run before setting EASYNUT_SEARCH_INDEX = 'table'
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ...ConnectionPool import pool
+from ...DAO import DAO
+from ...SearchIndex import table_search_index
+
+
+class Command(BaseCommand):
+
+    help = 'Build again the search index of the forms'
+
+    def handle(self, *args, **options):
+        daoobject = DAO()
+        daoobject.load_tables_config()
+        table_search_index.rebuild(daoobject.db, daoobject.tables_config)
+        pool.release()
+        self.stdout.write('Search index built for {} forms'.format(len(daoobject.tables_config)))
@@ -0,0 +1,505 @@
+# -*- coding: utf-8 -*-
+# Tests of the rewrites of the DAO and the reports against the algorithms they replaced
+# They run on the SQLite stand-in of the DB (see StandIn) or on plain data, without the easynutdata DB,
+# except the stress test of the MSF ID allocator, which needs MySQL and is skipped without it.
+from __future__ import unicode_literals
+from operator import itemgetter
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+import MySQLdb
+
+from . import ColumnarExport
+from .ColumnarExport import ColumnarExporter
+from .ConnectionPool import ConnectionPool, PoolTimeout
+from .DAO import DAO
+from .Exporter import Exporter, ExportJob
+from .ExternalExport import ExternalExport
+from .MsfIds import MsfIdAllocator
+from .ReportCache import ReportCache
+from .SearchIndex import MemorySearchIndex, TableSearchIndex, memory_search_index, searchable_fields, tokenize
+from .StandIn import StandInConnection
+
+
+# DAO on a stand-in connection, without taking one from the pool
+def stand_in_dao(db):
+    daoobject = DAO.__new__(DAO)
+    daoobject.db = db
+    daoobject.memo = {}
+    daoobject.memo_hits = 0
+    daoobject.memo_misses = 0
+    daoobject.external_fields = None
+    daoobject.set_tables_config()
+    return daoobject
+
+
+# get_record_with_type as it was: one query per field, and a LIKE query for the DB ID of the patient
+def per_field_record(daoobject, table_id, record_id, listFields):
+    c = daoobject.db.cursor()
+    record = [table_id, record_id]
+    recorddetails = []
+    patientId = '0'
+    for tablec in daoobject.tables_config:
+        if tablec['id'] == table_id:
+            record.append(tablec['name'])
+            for fieldc in tablec['fields']:
+                if (listFields and fieldc['list']) or (not listFields):
+                    c.execute('select {} from {} where _id = {}'.format(
+                        fieldc['field'], tablec['sql_table_config_name'], record_id))
+                    result = c.fetchone()[0]
+                    if fieldc['name'] == 'MSF ID':
+                        c.execute('SELECT _id FROM tabla_1 WHERE campo_1 LIKE "%{}%"'.format(result))
+                        row = c.fetchone()
+                        patientId = row[0] if row else '0'
+                    recorddetails.append([
+                        fieldc['field_id'],
+                        fieldc['type'],
+                        fieldc['pos'],
+                        fieldc['name'],
+                        result,
+                        fieldc['select'],
+                        ])
+    record.append(sorted(recorddetails, key=itemgetter(2)))
+    record.append(patientId)
+    if listFields and table_id == '1':
+        single_fields(c, record, daoobject.tables_config)
+    c.close()
+    return record
+
+
+# Custom calculations of the details of a patient as they were (addLastStepSingle, addNextAppointmentSingle):
+# one query per form for the last step, one for the next visit
+# The MSF ID is given as a parameter, as SQLite does not compare it as a number like MySQL.
+def single_fields(c, record, tables_config):
+    msfId = [field[4] for field in record[3] if field[3] == 'MSF ID'][0]
+    if not msfId:
+        return
+    laststeps = {}
+    for tablec in tables_config:
+        if tablec['id'] != '1':
+            c.execute('SELECT MAX(timestamp) FROM {} WHERE campo_2 = %s'.format(tablec['sql_table_config_name']),
+                      [msfId])
+            timestamp = c.fetchone()[0]
+            if timestamp:
+                laststeps[tablec['name']] = timestamp
+    if laststeps:
+        lastStep = max(laststeps, key=laststeps.get)
+        answer = lastStep + ' - ' + laststeps[lastStep].strftime('%a %d %b at %H:%M')
+    else:
+        answer = 'New'
+    record[3].append([0, 0, len(record[3]) + 1, 'Last step', answer, ''])
+    c.execute('SELECT campo_30 FROM tabla_8 WHERE campo_7 IS NOT NULL AND campo_2 = %s '
+              'ORDER BY timestamp DESC LIMIT 1', [msfId])
+    date = c.fetchone()
+    if date and date[0] is not None:
+        answer = datetime.datetime.strptime(date[0], '%Y-%m-%d').strftime('%A %d %B %Y')
+    else:
+        answer = 'Unknown'
+    record[3].append([0, 0, len(record[3]) + 1, 'Next visit', answer, ''])
+
+
+class GetRecordWithTypeTest(SimpleTestCase):
+
+    def setUp(self):
+        # 8 forms of 30 fields, so that the custom calculations of the details of a patient,
+        # folded into the query of the record, read the consultations (tabla_8.campo_7 and campo_30)
+        self.db = StandInConnection()
+        self.db.seed_forms(8, 30)
+        self.db.seed_records(8, 30, 3, 2)
+        c = self.db.cursor()
+        # Appointments of the consultations, none given to the third patient
+        c.execute("UPDATE tabla_8 SET campo_30 = '2017-07-0' || _id")
+        c.execute("UPDATE tabla_8 SET campo_7 = NULL WHERE campo_2 = '000003'")
+        # A fourth patient with no other form filled yet
+        c.execute("INSERT INTO tabla_1 (campo_1, user, timestamp) VALUES ('000004', 'admin', '2017-03-01 10:00:00')")
+        c.close()
+        self.db.commit()
+        self.daoobject = stand_in_dao(self.db)
+
+    def test_same_record(self):
+        for table_id, record_id in (('1', 1), ('1', 3), ('1', 4), ('3', 2), ('8', 5)):
+            for listFields in (True, False):
+                self.daoobject.memo.clear()
+                self.assertEqual(self.daoobject.get_record_with_type(table_id, record_id, listFields),
+                                 per_field_record(self.daoobject, table_id, record_id, listFields))
+
+    def test_one_query(self):
+        for table_id, record_id, listFields in (('3', 2, False), ('1', 1, True)):
+            self.daoobject.memo.clear()
+            self.db.queries = 0
+            self.daoobject.get_record_with_type(table_id, record_id, listFields)
+            self.assertEqual(self.db.queries, 1)
+
+
+# Search of the patients (form 1, MSF IDs 000001 to 000030) with the search indexes
+class SearchIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.db = StandInConnection()
+        self.db.seed_forms(2, 5)
+        self.db.seed_records(2, 5, 30, 1)
+        self.daoobject = stand_in_dao(self.db)
+        self.tablec = self.daoobject.tables_config[0]
+
+    # DB IDs of the patients matching the condition of the index for the keyword
+    def find(self, index, keyword):
+        sqlquery, params = index.condition('1', keyword)
+        c = self.db.cursor()
+        c.execute('SELECT _id FROM tabla_1 WHERE ' + sqlquery + ' ORDER BY _id', params)
+        record_ids = [row[0] for row in c.fetchall()]
+        c.close()
+        return record_ids
+
+    # The table index filled as rebuild does, without its MySQL only INSERT IGNORE
+    def table_index(self):
+        c = self.db.cursor()
+        c.execute('CREATE TABLE easy_search_index (table_id TEXT, record_id INTEGER, token TEXT)')
+        c.execute('SELECT _id, {} FROM tabla_1'.format(', '.join(searchable_fields(self.tablec))))
+        for row in c.fetchall():
+            tokens = set()
+            for value in row[1:]:
+                tokens |= tokenize(value)
+            for token in tokens:
+                self.db.db.execute('INSERT INTO easy_search_index VALUES (?, ?, ?)', ['1', row[0], token])
+        c.close()
+        return TableSearchIndex()
+
+    def memory_index(self):
+        index = MemorySearchIndex()
+        index.rebuild(self.db, self.daoobject.tables_config)
+        return index
+
+    def test_partial_msf_id(self):
+        for index in (self.memory_index(), self.table_index()):
+            self.assertEqual(self.find(index, '12'), [12])
+            self.assertEqual(self.find(index, '000012'), [12])
+            self.assertEqual(self.find(index, '1'), [1] + list(range(10, 20)))
+            self.assertEqual(self.find(index, '00001'), [1] + list(range(10, 20)))
+            self.assertEqual(self.find(index, '31'), [])
+
+    def test_edited_record(self):
+        index = self.memory_index()
+        c = self.db.cursor()
+        c.execute('UPDATE tabla_1 SET campo_1 = %s WHERE _id = 12', ['000042'])
+        c.close()
+        index.refresh(self.db, self.tablec, 12)
+        self.assertEqual(self.find(index, '12'), [])
+        self.assertEqual(self.find(index, '42'), [12])
+        index.remove(self.db, '1', 12)
+        self.assertEqual(self.find(index, '42'), [])
+        self.assertNotIn('000042', index.vocabulary['1'])
+
+    # A keyword without any word is looked for in the fields, as without index
+    @override_settings(EASYNUT_SEARCH_INDEX='memory')
+    def test_keyword_without_word(self):
+        c = self.db.cursor()
+        c.execute('UPDATE tabla_1 SET campo_2 = %s WHERE _id = 5', ['Jean-Paul'])
+        c.close()
+        memory_search_index.rebuild(self.db, self.daoobject.tables_config)
+        self.assertIsNone(memory_search_index.condition('1', '-'))
+        for keywords, record_ids in ((['-'], [5]), (['12', ''], [12]), (['jean', '-'], [5])):
+            sqlquery, params = self.daoobject.search_query(keywords, self.tablec)
+            c = self.db.cursor()
+            c.execute(sqlquery, params)
+            self.assertEqual([row[0] for row in c.fetchall()], record_ids)
+            c.close()
+
+
+# Absents report as it was: for each consultation in the window, up to four queries on the facts of the patient
+def per_row_absents(db, today):
+    c = db.cursor()
+    c.execute("SELECT bd.campo_1,bd.campo_2,bd.campo_14,c.campo_30 "
+              "FROM tabla_1 bd LEFT JOIN tabla_8 c ON (bd.campo_1 = c.campo_2) "
+              "WHERE bd.campo_14 IS NOT NULL AND bd.campo_14 <> 'NULL' "
+              "AND c.campo_30 IS NOT NULL AND c.campo_30 <> 'NULL' "
+              "ORDER BY c.campo_1 ")
+    reducedLists = {}
+    for absent in c.fetchall():
+        visitdate = datetime.datetime.strptime(absent[3], '%Y-%m-%d')
+        if not (visitdate + datetime.timedelta(days=7) <= today <= visitdate + datetime.timedelta(days=14)):
+            continue
+        c.execute('SELECT campo_1 FROM tabla_8 WHERE campo_2 = "' + absent[0] + '" '
+                  'AND campo_1 IS NOT NULL AND campo_1 <> "NULL" ORDER BY campo_1 DESC LIMIT 1')
+        lastVisit = c.fetchone()
+        if not (lastVisit and lastVisit[0] and datetime.datetime.strptime(lastVisit[0], '%Y-%m-%d') < visitdate):
+            continue
+        c.execute('SELECT campo_1 FROM tabla_5 WHERE campo_2 = "' + absent[0] + '" AND campo_3 = "Transfer out" '
+                  'AND campo_1 IS NOT NULL AND campo_1 <> "NULL" ORDER BY campo_1 DESC LIMIT 1')
+        lastIM = c.fetchone()
+        if lastIM and lastIM[0] and lastIM[0] != 'NULL' \
+                and datetime.datetime.strptime(lastIM[0], '%Y-%m-%d') > visitdate:
+            continue
+        c.execute('SELECT COUNT(*) FROM tabla_4 WHERE campo_2 = "' + absent[0] + '" ')
+        if int(c.fetchone()[0]) > 0:
+            continue
+        c.execute('SELECT campo_1 FROM tabla_17 WHERE campo_2 = "' + absent[0] + '" '
+                  'AND campo_1 IS NOT NULL AND campo_1 <> "NULL" ORDER BY campo_1 DESC LIMIT 1')
+        lastAbs = c.fetchone()
+        if lastAbs and lastAbs[0] and lastAbs[0] != 'NULL' \
+                and datetime.datetime.strptime(lastAbs[0], '%Y-%m-%d') > visitdate:
+            continue
+        if absent[0] not in reducedLists or \
+                visitdate > datetime.datetime.strptime(reducedLists[absent[0]][2], '%Y-%m-%d'):
+            reducedLists[absent[0]] = [absent[1], absent[2], absent[3]]
+    c.close()
+    return reducedLists
+
+
+# Absents report from the bulk fetches and computeAbsents
+# The rough window of getAbsents is left out of the first query, as it is MySQL only
+def bulk_absents(db, today):
+    c = db.cursor()
+    c.execute("SELECT bd.campo_1,bd.campo_2,bd.campo_14,c.campo_30 "
+              "FROM tabla_1 bd LEFT JOIN tabla_8 c ON (bd.campo_1 = c.campo_2) "
+              "WHERE bd.campo_14 IS NOT NULL AND bd.campo_14 <> 'NULL' "
+              "AND c.campo_30 IS NOT NULL AND c.campo_30 <> 'NULL' "
+              "ORDER BY c.campo_1 ")
+    listOfAbsents = c.fetchall()
+    lastVisits = ExternalExport.latestDates(c, 'tabla_8')
+    lastTransfers = ExternalExport.latestDates(c, 'tabla_5', [('campo_3', 'Transfer out')])
+    c.execute('SELECT DISTINCT campo_2 FROM tabla_4')
+    discharged = set(row[0] for row in c.fetchall())
+    lastCalls = ExternalExport.latestDates(c, 'tabla_17')
+    c.close()
+    return ExternalExport.computeAbsents(listOfAbsents, lastVisits, lastTransfers, discharged, lastCalls, today)
+
+
+class AbsentsTest(SimpleTestCase):
+
+    today = datetime.datetime(2017, 6, 30, 10, 0)
+
+    def setUp(self):
+        self.db = StandInConnection()
+        c = self.db.db.cursor()
+        c.execute('CREATE TABLE tabla_1 (campo_1 TEXT, campo_2 TEXT, campo_14 TEXT)')
+        # Consultations: date of the visit, patient, next appointment
+        c.execute('CREATE TABLE tabla_8 (campo_1 TEXT, campo_2 TEXT, campo_30 TEXT)')
+        # Internal movements: date, patient, kind
+        c.execute('CREATE TABLE tabla_5 (campo_1 TEXT, campo_2 TEXT, campo_3 TEXT)')
+        c.execute('CREATE TABLE tabla_4 (campo_1 TEXT, campo_2 TEXT)')
+        c.execute('CREATE TABLE tabla_17 (campo_1 TEXT, campo_2 TEXT)')
+        c.close()
+
+    def day(self, days):
+        return (self.today - datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+
+    # Patient msf_id with consultations [(days ago of the visit, days ago of the next appointment)]
+    def patient(self, msf_id, consultations, phone='0123', **facts):
+        c = self.db.db.cursor()
+        c.execute('INSERT INTO tabla_1 VALUES (?, ?, ?)', [msf_id, 'Patient ' + msf_id, phone])
+        for visit, appointment in consultations:
+            c.execute('INSERT INTO tabla_8 VALUES (?, ?, ?)', [
+                None if visit is None else self.day(visit), msf_id,
+                None if appointment is None else self.day(appointment)])
+        for days, kind in facts.get('transfers', []):
+            c.execute('INSERT INTO tabla_5 VALUES (?, ?, ?)', [self.day(days), msf_id, kind])
+        for days in facts.get('discharges', []):
+            c.execute('INSERT INTO tabla_4 VALUES (?, ?)', [self.day(days), msf_id])
+        for days in facts.get('calls', []):
+            c.execute('INSERT INTO tabla_17 VALUES (?, ?)', [self.day(days), msf_id])
+        c.close()
+
+    def assertSameAbsents(self, expected):
+        self.db.commit()
+        absents = bulk_absents(self.db, self.today)
+        self.assertEqual(absents, per_row_absents(self.db, self.today))
+        self.assertEqual(sorted(absents), sorted(expected))
+
+    def test_window_edges(self):
+        self.patient('000001', [(30, 6)])
+        self.patient('000002', [(30, 7)])
+        self.patient('000003', [(30, 10)])
+        self.patient('000004', [(30, 13)])
+        self.patient('000005', [(30, 14)])
+        self.patient('000006', [(30, 15)])
+        # today is after midnight, so the 14th day is already out of the window
+        self.assertSameAbsents(['000002', '000003', '000004'])
+
+    def test_last_visit(self):
+        # No date of visit at all
+        self.patient('000001', [(None, 10)])
+        # Came back after the appointment, or on the day
+        self.patient('000002', [(30, 10), (5, None)])
+        self.patient('000003', [(30, 10), (10, None)])
+        self.patient('000004', [(30, 10), (20, None)])
+        self.assertSameAbsents(['000004'])
+
+    def test_transfer_out(self):
+        self.patient('000001', [(30, 10)], transfers=[(5, 'Transfer out')])
+        self.patient('000002', [(30, 10)], transfers=[(20, 'Transfer out')])
+        self.patient('000003', [(30, 10)], transfers=[(5, 'Transfer in')])
+        self.patient('000004', [(30, 10)], transfers=[(20, 'Transfer out'), (5, 'Transfer out')])
+        self.assertSameAbsents(['000002', '000003'])
+
+    def test_discharged(self):
+        self.patient('000001', [(30, 10)], discharges=[40])
+        self.patient('000002', [(30, 10)], discharges=[5])
+        self.patient('000003', [(30, 10)])
+        self.assertSameAbsents(['000003'])
+
+    def test_absent_call(self):
+        self.patient('000001', [(30, 10)], calls=[5])
+        self.patient('000002', [(30, 10)], calls=[10])
+        self.patient('000003', [(30, 10)], calls=[20, 3])
+        self.patient('000004', [(30, 10)], calls=[20])
+        self.assertSameAbsents(['000002', '000004'])
+
+    def test_several_rows(self):
+        # The latest appointment in the window is kept
+        self.patient('000001', [(40, 13), (30, 9), (25, 11)])
+        # One in the window, but the patient came to a later visit
+        self.patient('000002', [(40, 12), (11, 30)])
+        # No phone number
+        self.patient('000003', [(40, 10)], phone=None)
+        self.patient('000004', [(40, 10)], phone='NULL')
+        self.assertSameAbsents(['000001'])
+        self.assertEqual(bulk_absents(self.db, self.today)['000001'][2], self.day(9))
+
+
+# Columnar exports of a form of 60 records, by batches of 25 rows
+# The progress is read as ExportJob.dump does, while the form is being written.
+class ColumnarExportTest(SimpleTestCase):
+
+    def setUp(self):
+        self.db = StandInConnection()
+        self.db.seed_forms(2, 8)
+        self.db.seed_records(2, 8, 20, 3)
+        self.tablec = stand_in_dao(self.db).tables_config[1]
+        self.exporter = ColumnarExporter(Exporter([self.tablec]))
+        self.exporter.rows_per_batch = 25
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    # Export the form and return the path of the file and the progress reported
+    def export(self, fmt):
+        path = os.path.join(self.dir, self.exporter.filename(self.tablec, fmt))
+        progress = []
+        self.exporter.write(self.db, self.tablec, path, fmt, lambda rows: progress.append((rows, ExportJob.size(path))))
+        self.assertEqual([rows for rows, size in progress], [25, 50, 60])
+        return path, progress
+
+    def test_npz(self):
+        numpy = ColumnarExport.numpy
+        if numpy is None:
+            self.skipTest('numpy is not installed')
+        path, progress = self.export('npz')
+        # The file is only written once all the rows are read
+        self.assertEqual([size for rows, size in progress], [0, 0, 0])
+        columns, kinds, sqlquery = self.exporter.columns(self.tablec)
+        arrays = numpy.load(path)
+        self.assertEqual(list(arrays['columns']), columns)
+        self.assertEqual(list(arrays['kinds']), kinds)
+        self.assertEqual(list(arrays['c0']), list(range(1, 61)))
+        self.assertEqual(str(arrays['c1'][0]), '2017-01-01')
+        self.assertEqual(list(arrays['c{}_categories'.format(kinds.index('category'))]), ['4'])
+        self.assertEqual(arrays['c{}'.format(kinds.index('number'))][0], 6.0)
+        self.assertEqual(str(arrays['c{}'.format(len(kinds) - 1)][0]), '2017-01-01T02:00:00')
+
+    def test_parquet(self):
+        if ColumnarExport.pyarrow is None:
+            self.skipTest('pyarrow is not installed')
+        path, progress = self.export('parquet')
+        columns, kinds, sqlquery = self.exporter.columns(self.tablec)
+        table = ColumnarExport.pyarrow.parquet.read_table(path)
+        self.assertEqual(table.column_names, columns)
+        self.assertEqual(table.num_rows, 60)
+        self.assertEqual(table.column(0).to_pylist(), list(range(1, 61)))
+        self.assertEqual(table.column(1).to_pylist()[0], datetime.date(2017, 1, 1))
+        self.assertEqual(table.column(len(kinds) - 1).to_pylist()[0], datetime.datetime(2017, 1, 1, 2, 0))
+
+
+# Lock of the generation of a report taken over by another generation once too old
+class ReportCacheLockTest(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.lock = os.path.join(self.dir, 'absents.lock')
+        self.cache = ReportCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_overran_generation_keeps_new_lock(self):
+        first = self.cache.acquire(self.lock)
+        self.assertIsNotNone(first)
+        self.assertIsNone(self.cache.acquire(self.lock))
+        # The first generation overran lock_timeout: its lock is removed, then taken by a second one
+        os.utime(self.lock, (0, 0))
+        self.assertIsNone(self.cache.acquire(self.lock))
+        second = self.cache.acquire(self.lock)
+        self.assertIsNotNone(second)
+        self.cache.release(self.lock, first)
+        self.assertIsNone(self.cache.acquire(self.lock))
+        self.cache.release(self.lock, second)
+        self.assertFalse(os.path.exists(self.lock))
+
+
+# Many threads reserving blocks of MSF IDs at the same time, each on its own connection of the pool
+# The test runs on the scratch DB named by EASYNUT_TEST_DATABASE, on the server of the easynutdata DB,
+# never on the easynutdata DB itself, and is skipped without it. Its sequence is removed at the end.
+class MsfIdAllocatorStressTest(SimpleTestCase):
+
+    threads = 8
+    reservations = 50
+
+    def setUp(self):
+        name = getattr(settings, 'EASYNUT_TEST_DATABASE', None)
+        if not name or name == settings.DATABASES['data']['NAME']:
+            self.skipTest('EASYNUT_TEST_DATABASE does not name a scratch DB')
+        self.pool = ConnectionPool(name)
+        try:
+            self.db = self.pool.checkout()
+        except (MySQLdb.Error, PoolTimeout) as e:
+            self.skipTest('The test DB is not available: {}'.format(e))
+        # The sequence starts after the MSF IDs of tabla_1
+        c = self.db.cursor()
+        c.execute('CREATE TABLE IF NOT EXISTS tabla_1 (_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, campo_1 TEXT)')
+        c.close()
+        self.allocator = MsfIdAllocator()
+        self.allocator.sequence = 'stress_test'
+        self.allocator.ensure(self.db)
+
+    def tearDown(self):
+        c = self.db.cursor()
+        c.execute('DELETE FROM easy_sequences WHERE name = %s', [self.allocator.sequence])
+        c.close()
+        self.db.commit()
+        self.pool.checkin(self.db)
+
+    def test_no_duplicates(self):
+        msf_ids = []
+        errors = []
+        lock = threading.Lock()
+
+        def work(n):
+            db = self.pool.checkout()
+            try:
+                for i in range(self.reservations):
+                    block = self.allocator.reserve(db, 1 + (n + i) % 5)
+                    with lock:
+                        msf_ids.extend(block)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                self.pool.checkin(db)
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(msf_ids), sum(1 + (n + i) % 5 for n in range(self.threads)
+                                           for i in range(self.reservations)))
+        self.assertEqual(len(set(msf_ids)), len(msf_ids))
+        # No gap either: the IDs follow each other
+        values = sorted(int(msf_id) for msf_id in msf_ids)
+        self.assertEqual(values, list(range(values[0], values[0] + len(values))))
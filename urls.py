@@ -16,6 +16,7 @@ urlpatterns = [
     # url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     url(r'^$', views.index, name='index'),
     url(r'^(?P<record_id>[0-9]+)/patient/$', views.patient, name='patient'),
+    url(r'^(?P<record_id>[0-9]+)/patientgraphs/$', views.patientgraphs, name='patientgraphs'),
     url(r'^(?P<table_id>[0-9]+)/(?P<record_id>[0-9]+)/detail/$', views.detail, name='detail'),
     url(r'^(?P<table_id>[0-9]+)/(?P<record_id>[0-9]+)/edit/$', views.edit, name='edit'),
     url(
@@ -27,6 +28,10 @@ urlpatterns = [
     url(r'^save/$', views.save, name='save'),
     url(r'^(?P<table_id>[0-9]+)/(?P<record_id>[0-9]+)/deleterecord/$', views.deleterecord, name='deleterecord'),
     url(r'^downloadexport/$', views.downloadexport, name='downloadexport'),
+    url(r'^reservemsfids/$', views.reservemsfids, name='reservemsfids'),
+    url(r'^startexport/$', views.startexport, name='startexport'),
+    url(r'^exportstatus/(?P<job_id>[0-9a-f]{32})/$', views.exportstatus, name='exportstatus'),
+    url(r'^downloadexportjob/(?P<job_id>[0-9a-f]{32})/$', views.downloadexportjob, name='downloadexportjob'),
     url(r'^downloadbackup/$', views.downloadbackup, name='downloadbackup'),
     url(r'^downloadabsents/$', views.downloadabsents, name='downloadabsents'),
     url(r'^downloaddefaulters/$', views.downloaddefaulters, name='downloaddefaulters'),
@@ -2,14 +2,24 @@
 from __future__ import unicode_literals
 import os
 
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseRedirect, HttpResponse, Http404
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse,
+)
 from django.shortcuts import render
 from django.urls import reverse
+from django.views.decorators.http import require_POST
 
+from .ColumnarExport import available_formats
 from .DAO import DAO
+from .Exporter import Exporter, ExportJob
 from .ExternalExport import ExternalExport
+from .GrowthCharts import growth_charts
+from .MsfIds import MsfIdResolver, msf_id_allocator
+from .Permissions import permissions
+from .ReportCache import report_cache
 
 from graphos.renderers import flot
 from graphos.sources.simple import SimpleDataSource
@@ -55,7 +65,7 @@ def index(request):
     # Last ID not used anymore
     return render(request, template_name, {
         'edbtables': daoobject.tables_config_lite,
-        'lastId': daoobject.getLastId('tabla_1', 'campo_1'),
+        'lastId': daoobject.getLastMsfId(),
         'easyUser': daoobject.easy_user,
     })
 
@@ -67,24 +77,17 @@ def results(request):
     search_query = request.GET.get('searchstring')
     daoobject = DAO()
     daoobject = getTableConfigandUser(request, daoobject)
-    regularsearch = render(request, template_name, {
+    # Exact MSF ID: go directly to the patient
+    msfId = MsfIdResolver.normalize(search_query)
+    if msfId:
+        patientId = daoobject.doesIdExist(msfId)
+        if patientId:
+            return patient(request, patientId)
+    return render(request, template_name, {
         'searchresults': daoobject.search(search_query, '1'),
-        'lastId': daoobject.getLastId('tabla_1', 'campo_1'),
+        'lastId': daoobject.getLastMsfId(),
         'easyUser': daoobject.easy_user,
     })
-    try:
-        searchInt = int(search_query)
-        searchStr = str(searchInt)
-        zerosToAdd = 6-len(searchStr)
-        IdToReturn = ''
-        for i in xrange(zerosToAdd):
-            IdToReturn = IdToReturn + '0'
-        if daoobject.doesIdExist(IdToReturn + searchStr):
-            return patient(request, daoobject.doesIdExist(IdToReturn + searchStr))
-        else:
-            return regularsearch
-    except ValueError:
-        return regularsearch
 
 
 # Display patient summary
@@ -93,7 +96,7 @@ def patient(request, record_id):
     template_name = 'emr/patient.html'
     daoobject = DAO()
     daoobject = getTableConfigandUser(request, daoobject)
-    daoobject.set_graphs(record_id)
+    daoobject.set_graphs(record_id, **growth_charts.page_window())
     # Initialise graphos chart objects
     charts = []
     for graph in daoobject.graphs:
@@ -117,16 +120,16 @@ def patient(request, record_id):
         ])
     daoobject.get_record_with_type('1', record_id, True)
     daoobject.get_related_records(record_id)
-    daoobject.getLastId('tabla_1', 'campo_1')
 
-    return render(request, template_name, {
+    response = render(request, template_name, {
         'record': daoobject.get_record_with_type('1', record_id, True),
         'relatedrecords': daoobject.get_related_records(record_id),
         'charts': charts,
         'graphs': daoobject.graphs,
-        'lastId': daoobject.getLastId('tabla_1', 'campo_1'),
+        'lastId': daoobject.getLastMsfId(),
         'easyUser': daoobject.easy_user,
     })
+    return addDebugHeaders(response, daoobject)
 
 
 # View a specific record
@@ -138,8 +141,9 @@ def detail(request, table_id, record_id):
     if daoobject.backEndUserRolesCheck(table_id, 'view_table'):
         return render(request, template_name, {
             'record': daoobject.get_record_with_type(table_id, record_id, False),
-            'lastId': daoobject.getLastId('tabla_1', 'campo_1'),
+            'lastId': daoobject.getLastMsfId(),
             'easyUser': daoobject.easy_user,
+            'permissions': daoobject.easy_user['tables'][table_id],
         })
     return index(request)
 
@@ -153,7 +157,7 @@ def edit(request, table_id, record_id):
     if daoobject.backEndUserRolesCheck(table_id, 'edit_table'):
         return render(request, template_name, {
             'record': daoobject.get_record_with_type(table_id, record_id, False),
-            'lastId': daoobject.getLastId('tabla_1', 'campo_1'),
+            'lastId': daoobject.getLastMsfId(),
             'easyUser': daoobject.easy_user,
         })
     return index(request)
@@ -204,7 +208,7 @@ def addrecord(request, table_id, related_record_entry):
                 'recordform': daoobject.getrecordform(table_id),
                 'related_record_entry': related_record_entry,
                 'related_record_field': related_record_field,
-                'lastId': daoobject.getLastId('tabla_1', 'campo_1'),
+                'lastId': daoobject.getLastMsfId(),
                 'easyUser': daoobject.easy_user,
             })
     return index(request)
@@ -226,13 +230,90 @@ def downloadexport(request):
     daoobject = DAO()
     daoobject = getTableConfigandUser(request, daoobject)
     # If user is in group "Admin"
+    if daoobject.easy_user['canExport']:
+        exporter = Exporter(daoobject.tables_config)
+        response = StreamingHttpResponse(exporter.stream_zip(), content_type="application/zip")
+        response['Content-Disposition'] = 'inline; filename=' + exporter.filename() + '.zip'
+        return response
+    else:
+        return index(request)
+
+
+# Start a raw export in the background, returns the id of the job
+# GET parameter format: csv (default), or parquet / npz if their library is installed
+@login_required
+def startexport(request):
+    daoobject = DAO()
+    daoobject = getTableConfigandUser(request, daoobject)
+    if daoobject.easy_user['canExport']:
+        fmt = request.GET.get('format', 'csv')
+        if fmt not in available_formats():
+            return JsonResponse({'error': 'Format not available', 'formats': available_formats()}, status=400)
+        job = ExportJob.start(daoobject.tables_config, fmt)
+        return JsonResponse(job.progress)
+    else:
+        return index(request)
+
+
+# Points of the charts of a patient, as json, for the ranges not shown on the patient page
+# GET parameters (all optional): start and end (timestamps in ms), max_points
+@login_required
+def patientgraphs(request, record_id):
+    daoobject = DAO()
+    daoobject = getTableConfigandUser(request, daoobject)
+    try:
+        window = dict((name, int(request.GET[name]))
+                      for name in ('start', 'end', 'max_points') if request.GET.get(name))
+    except ValueError:
+        return JsonResponse({'error': 'start, end and max_points must be integers'}, status=400)
+    graphs = daoobject.set_graphs(record_id, **window)
+    return JsonResponse({'graphs': [
+        {'table_id': graph[0], 'x': graph[1], 'y': graph[2], 'data': graph[3][1:]}
+        for graph in graphs if daoobject.backEndUserRolesCheck(graph[0], 'view_table')
+    ]})
+
+
+# Reserve a block of MSF IDs, for a tablet registering patients offline
+# POST only (with the CSRF token), as it uses up IDs
+# POST parameter count: number of IDs, at most EASYNUT_MSF_ID_BLOCK_MAX
+@login_required
+@require_POST
+def reservemsfids(request):
+    daoobject = DAO()
+    daoobject = getTableConfigandUser(request, daoobject)
+    if daoobject.backEndUserRolesCheck('1', 'add_table'):
+        try:
+            count = int(request.POST.get('count', 1))
+        except ValueError:
+            count = 0
+        if not 0 < count <= getattr(settings, 'EASYNUT_MSF_ID_BLOCK_MAX', 100):
+            return JsonResponse({'error': 'Invalid count'}, status=400)
+        return JsonResponse({'msf_ids': msf_id_allocator.reserve(daoobject.db, count)})
+    else:
+        return index(request)
+
+
+# Progress of a raw export started in the background
+@login_required
+def exportstatus(request, job_id):
     if request.user.groups.filter(id=2).exists():
-        zip = daoobject.generateExport()+'.zip'
-        if os.path.exists(zip):
-            with open(zip, 'rb') as fh:
-                response = HttpResponse(fh.read(), content_type="application/zip")
-                response['Content-Disposition'] = 'inline; filename=' + os.path.basename(zip)
-                return response
+        progress = ExportJob.status(job_id)
+        if progress is not None:
+            return JsonResponse(progress)
+        raise Http404
+    else:
+        return index(request)
+
+
+# Download a raw export made in the background
+@login_required
+def downloadexportjob(request, job_id):
+    if request.user.groups.filter(id=2).exists():
+        zip = ExportJob.archive(job_id)
+        if zip is not None and os.path.exists(zip):
+            response = FileResponse(open(zip, 'rb'), content_type="application/zip")
+            response['Content-Disposition'] = 'inline; filename=' + os.path.basename(zip)
+            return response
         raise Http404
     else:
         return index(request)
@@ -243,7 +324,7 @@ def downloadexport(request):
 def downloadsfexport(request):
     daoobject = DAO()
     daoobject = getTableConfigandUser(request, daoobject)
-    if request.user.groups.filter(id=2).exists():
+    if daoobject.easy_user['canExport']:
         zip = daoobject.generateSingleFileExport()+'.zip'
         if os.path.exists(zip):
             with open(zip, 'rb') as fh:
@@ -260,7 +341,7 @@ def downloadsfexport(request):
 def downloadbackup(request):
     daoobject = DAO()
     daoobject = getTableConfigandUser(request, daoobject)
-    if request.user.groups.filter(id=2).exists():
+    if daoobject.easy_user['canExport']:
         file = u'/opt/shared/backup.gz.enc'
         if os.path.exists(file):
             with open(file, 'rb') as fh:
@@ -279,12 +360,11 @@ def downloadbackup(request):
 def downloadabsents(request):
     extE = ExternalExport()
     if request.user.groups.filter(id=2).exists():
-        csv = extE.getAbsents()
+        csv = report_cache.get('Absents', extE.getAbsents)
         if os.path.exists(csv):
-            with open(csv, 'rb') as fh:
-                response = HttpResponse(fh.read(), content_type="text/csv")
-                response['Content-Disposition'] = 'inline; filename=' + os.path.basename(csv)
-                return response
+            response = FileResponse(open(csv, 'rb'), content_type="text/csv")
+            response['Content-Disposition'] = 'inline; filename=Absents.csv'
+            return response
         raise Http404
     else:
         return index(request)
@@ -296,33 +376,46 @@ def downloadabsents(request):
 def downloaddefaulters(request):
     extE = ExternalExport()
     if request.user.groups.filter(id=2).exists():
-        csv = extE.getDefaulters()
+        csv = report_cache.get('Defaulters', extE.getDefaulters)
         if os.path.exists(csv):
-            with open(csv, 'rb') as fh:
-                response = HttpResponse(fh.read(), content_type="text/csv")
-                response['Content-Disposition'] = 'inline; filename=' + os.path.basename(csv)
-                return response
+            response = FileResponse(open(csv, 'rb'), content_type="text/csv")
+            response['Content-Disposition'] = 'inline; filename=Defaulters.csv'
+            return response
         raise Http404
     else:
         return index(request)
 
-# Create sessions variables for expensive functions    
+# Report the request cache of the DAO when debugging
+def addDebugHeaders(response, daoobject):
+    if settings.DEBUG:
+        response['X-EasyNut-Cache'] = 'hits={}; misses={}'.format(daoobject.memo_hits, daoobject.memo_misses)
+        if daoobject.external_fields is not None:
+            response['X-EasyNut-Plugins'] = '; '.join(
+                '{}={}x{:.1f}ms'.format(name.replace(' ', '-'), calls, seconds * 1000)
+                for name, (calls, seconds) in sorted(daoobject.external_fields.timings.items()))
+    return response
+
+# Create sessions variables for expensive functions
+# The configuration of the forms is kept in the schema registry, the session only keeps its version
 @receiver(user_logged_in)
 def setTableConfigsAndUser(sender, user, request, **kwargs):
     daoobject = DAO()
-    request.session['tableConfig'] = daoobject.set_tables_config()
-    request.session['tableConfigLite'] = daoobject.tables_config_lite
+    request.session['schemaVersion'] = daoobject.load_tables_config()
     request.session['easyUser'] = daoobject.setEasyUser(request.user)
     return
 
 def getTableConfigandUser(request, daoobject):
-    if request.session['tableConfig'] and request.session['tableConfigLite']:
-        daoobject.tables_config = request.session['tableConfig']
-        daoobject.tables_config_lite = request.session['tableConfigLite']
-    else:
-        daoobject.set_tables_config()
-    if request.session['easyUser']:
-        daoobject.easy_user = request.session['easyUser']
+    version = daoobject.load_tables_config()
+    # Sessions created before the registry carried the whole configuration
+    request.session.pop('tableConfig', None)
+    request.session.pop('tableConfigLite', None)
+    # The permissions depend on the list of forms and on the roles,
+    # so compute them again if the schema or the roles changed
+    rolesVersion = permissions.load(daoobject.db)
+    easyUser = request.session.get('easyUser')
+    if easyUser and request.session.get('schemaVersion') == version and easyUser.get('rolesVersion') == rolesVersion:
+        daoobject.easy_user = easyUser
     else:
-        daoobject.setEasyUser(request.user)
+        request.session['schemaVersion'] = version
+        request.session['easyUser'] = daoobject.setEasyUser(request.user)
     return daoobject